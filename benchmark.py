@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+import argparse
+import BaseHTTPServer
+import json
+import os
+import random
+import shutil
+import SocketServer
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import zlib
+from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape
+
+SCRAPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scraper.py")
+
+PLATFORM_ID   = "7"
+PLATFORM_NAME = "Nintendo Entertainment System (NES)"
+
+WORDS = ("super mario bros legend zelda mega man metroid contra castlevania duck tales "
+         "kirby adventure dragon quest warrior final fantasy ninja gaiden double dragon "
+         "punch out river city ransom tecmo bowl excitebike balloon fight ice climber "
+         "battletoads blaster master crystalis faxanadu startropics bubble bobble").split()
+SUFFIXES = ["", "", "", " II", " III", " 2", " 3", ": The Lost Levels", " - Return of the King"]
+REGIONS = ["(USA)", "(Europe)", "(Japan)", "(USA, Europe)", "(World) (Rev 1)"]
+
+# Catalog titles, and ROM names that only match them once their dashes
+# are dropped or replaced by spaces. Every run checks they were matched.
+DASHED = [
+    ("Spider-Man", ["Spiderman", "Spider Man"]),
+    ("X-Men",      ["XMen", "X Men"]),
+]
+
+# Each scenario runs on the state (cache, gamelist, boxart) left by the
+# previous one, except for the matches it picked
+SCENARIOS = [
+    ('cold',        ['-l']),
+    ('warm',        ['-l', '-f']),
+    ('incremental', ['-l']),
+    ('crc',         ['-l', '-f', '-crc']),
+    ('lucky',       ['-l', '-f', '-j', '8', '--no-cache']),
+]
+
+parser = argparse.ArgumentParser(description='Benchmark for ES-scraper, runs it against a local fake thegamesdb')
+parser.add_argument('--sizes', metavar="N,..", help="ROM library sizes to benchmark (default: 1000)", default="1000")
+parser.add_argument('--scenarios', metavar="name,..", help="scenarios to run (default: %s)" % ",".join(s[0] for s in SCENARIOS),
+                    default=",".join(s[0] for s in SCENARIOS))
+parser.add_argument('--catalog', metavar="N", help="games in the fake platform catalog (default: 5000)", type=int, default=5000)
+parser.add_argument('--latency', metavar="secs", help="delay added to every API request (default: 0)", type=float, default=0)
+parser.add_argument('--errors', metavar="ratio", help="share of API requests answered with a 503 (default: 0)", type=float, default=0)
+parser.add_argument('--rom-size', metavar="bytes", help="size of each generated ROM (default: 4096)", type=int, default=4096)
+parser.add_argument('--image-size', metavar="WxH", help="size of the served boxart (default: 500x700)", default="500x700")
+parser.add_argument('--scraper-args', metavar="args", help="extra arguments for every scraper run, e.g. \"-pisize\"", default="")
+parser.add_argument('--workdir', metavar="dir", help="where ROMs, cache and logs are generated (default: a temporary folder)")
+parser.add_argument('--keep', help="keep the work folder afterwards", action='store_true')
+parser.add_argument('-o', metavar="file", help="also write the results to this file")
+args = parser.parse_args()
+
+def makeTitles(count, seed=0):
+    rnd = random.Random(seed)
+    titles = []
+    seen = set()
+    while len(titles) < count:
+        title = " ".join(w.capitalize() for w in rnd.sample(WORDS, rnd.randint(1, 4))) + rnd.choice(SUFFIXES)
+        if title not in seen:
+            seen.add(title)
+            titles.append(title)
+    return titles + [title for title, names in DASHED]
+
+def makePNG(width, height):
+    # Smallest valid PNG we can build without PIL, a plain RGB image
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+    raw = ('\x00' + '\x80\x20\x20'*width) * height
+    return ('\x89PNG\r\n\x1a\n' + chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk('IDAT', zlib.compress(raw)) + chunk('IEND', ''))
+
+def gzipped(data):
+    encoder = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return encoder.compress(data) + encoder.flush()
+
+class FakeGamesDB(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves canned GetPlatform/GetGamesList/GetGame XML and boxart. Games
+    carry the fields read with -crc (title, system_title..) as well."""
+    daemon_threads = True
+
+    def __init__(self, titles, image, latency, errors):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeGamesDBHandler)
+        self.titles = titles
+        self.image = image
+        self.etag = '"%x"' % (zlib.crc32(image) & 0xFFFFFFFF)
+        self.latency = latency
+        self.errors = errors
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.gameslist_gz = None
+        self.reset()
+        self.gameslist = "<Data>%s</Data>" % "".join(
+            "<Game><id>%s</id><GameTitle>%s</GameTitle><ReleaseDate>01/01/1990</ReleaseDate>"
+            "<Platform>%s</Platform><title>%s</title><system_title>%s</system_title></Game>"
+            % (i+1, escape(t), escape(PLATFORM_NAME), escape(t), escape(PLATFORM_NAME))
+            for i, t in enumerate(titles))
+
+    def compress(self, body):
+        # The game list is the same every time, only compress it once
+        if body is self.gameslist:
+            if self.gameslist_gz is None:
+                self.gameslist_gz = gzipped(body)
+            return self.gameslist_gz
+        return gzipped(body)
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.sent = 0
+
+    def count(self, endpoint, size):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.sent += size
+
+    def gameInfo(self, id):
+        try:
+            title = self.titles[int(id)-1]
+        except (ValueError, IndexError):
+            return "<Data></Data>"
+        boxart = "boxart/original/front/%s-1.png" % id
+        return ("<Data><baseImgUrl>http://thegamesdb.net/banners/</baseImgUrl><Game><id>%s</id>"
+                "<GameTitle>%s</GameTitle><Platform>%s</Platform><ReleaseDate>01/01/1990</ReleaseDate>"
+                "<Overview>Overview of %s.</Overview><Genres><genre>Action</genre><genre>Platform</genre></Genres>"
+                "<Rating>7.5</Rating><Publisher>Publisher</Publisher><Developer>Developer</Developer>"
+                "<Images><boxart side=\"front\">%s</boxart></Images>"
+                "<title>%s</title><system_title>%s</system_title><description>Overview of %s.</description>"
+                "<box_front>http://127.0.0.1:%s/banners/%s</box_front><developer>Developer</developer>"
+                "<genre>Action&gt;Platform</genre></Game></Data>"
+                % (id, escape(title), escape(PLATFORM_NAME), escape(title), boxart,
+                   escape(title), escape(PLATFORM_NAME), escape(title), self.server_address[1], boxart))
+
+class FakeGamesDBHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body in one write, or Nagle delays every kept-alive reply
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, endpoint, body, ctype="text/xml", status=200, headers={}):
+        if ctype == "text/xml" and 'gzip' in (self.headers.getheader('accept-encoding') or ''):
+            body = self.server.compress(body)
+            headers = dict(headers, **{'Content-Encoding': "gzip"})
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(endpoint, len(body))
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.getheader('content-length') or 0)
+        if length:
+            params.update(urlparse.parse_qsl(self.rfile.read(length)))
+        server = self.server
+        endpoint = os.path.basename(url.path)
+
+        if url.path.startswith("/banners/"):
+            if self.headers.getheader('if-none-match') == server.etag:
+                return self.reply("banners", "", status=304, headers={'ETag': server.etag})
+            return self.reply("banners", server.image, "image/png", headers={'ETag': server.etag})
+
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            failed = server.random.random() < server.errors
+        if failed:
+            return self.reply("errors", "Service Unavailable", "text/plain", status=503)
+        if endpoint == "GetPlatform.php":
+            self.reply(endpoint, "<Data><Platform><Platform>%s</Platform></Platform></Data>" % escape(PLATFORM_NAME))
+        elif endpoint == "GetPlatformsList.php":
+            self.reply(endpoint, "<Data><Platforms><Platform><id>%s</id><name>%s</name></Platform></Platforms></Data>"
+                       % (PLATFORM_ID, escape(PLATFORM_NAME)))
+        elif endpoint == "GetGamesList.php":
+            self.reply(endpoint, server.gameslist)
+        elif endpoint == "GetGame.php":
+            self.reply(endpoint, server.gameInfo(params.get('id')))
+        else:
+            self.reply(endpoint, "", status=404)
+
+    do_POST = do_GET
+
+def makeRoms(roms, titles, first, count, romsize):
+    # ROMs named after catalog titles (with region tags), 500 per folder
+    rnd = random.Random(first)
+    files = []
+    for i in range(first, first + count):
+        folder = os.path.join(roms, "%03d" % (i // 500))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        name = "%s %s [%s].nes" % (rnd.choice(titles), rnd.choice(REGIONS), i)
+        path = os.path.join(folder, name.replace('/', '-'))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(romsize))
+        files.append(path)
+    return files
+
+def makeVariants(roms, titles, romsize):
+    # The DASHED ROMs, and the game id each of them should get
+    folder = os.path.join(roms, "variants")
+    os.makedirs(folder)
+    expected = {}
+    for title, names in DASHED:
+        for name in names:
+            path = os.path.join(folder, "%s (USA).nes" % name)
+            with open(path, 'wb') as f:
+                f.write(os.urandom(romsize))
+            expected[path] = str(titles.index(title) + 1)
+    return expected
+
+def checkVariants(roms, expected):
+    # The DASHED ROMs that didn't get their game
+    found = {}
+    try:
+        for game in ET.parse(os.path.join(roms, "gamelist.xml")).getroot().iter('game'):
+            found[game.findtext('path')] = game.findtext('id')
+    except (IOError, ET.ParseError):
+        pass
+    return sorted(os.path.basename(path) for path, id in expected.items() if found.get(path) != id)
+
+def makeLibrary(workdir, titles, size, romsize):
+    home = os.path.join(workdir, "home")
+    roms = os.path.join(workdir, "roms")
+    config = os.path.join(home, ".emulationstation")
+    os.makedirs(config)
+    files = makeRoms(roms, titles, 0, size, romsize)
+    variants = makeVariants(roms, titles, romsize)
+    files.extend(variants)
+    with open(os.path.join(config, "es_systems.cfg"), 'w') as f:
+        f.write("NAME=nes\nDESCNAME=Benchmark\nPATH=%s/\nEXTENSION=.nes\nCOMMAND=true\nPLATFORMID=%s\n"
+                % (roms, PLATFORM_ID))
+    return home, roms, files, variants
+
+def runScraper(server, home, workdir, name, options):
+    env = dict(os.environ)
+    env.pop('SUDO_USER', None)
+    env['HOME'] = home
+    env['ES_SCRAPER_GAMESDB'] = "http://127.0.0.1:%s/" % server.server_address[1]
+    stats = os.path.join(workdir, "%s.stats" % name)
+    command = [sys.executable, SCRAPER, '--stats', stats] + options + args.scraper_args.split()
+    server.reset()
+    with open(os.path.join(workdir, "%s.log" % name), 'w') as log:
+        start = time.time()
+        status = subprocess.call(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+        elapsed = time.time() - start
+    # Per-stage timings, one line per system
+    try:
+        with open(stats) as f:
+            systems = [json.loads(line) for line in f]
+    except IOError:
+        systems = []
+    return status, elapsed, systems
+
+def benchmark(size, titles, image, scenarios):
+    workdir = os.path.abspath(tempfile.mkdtemp(prefix="es-scraper-bench-", dir=args.workdir))
+    server = FakeGamesDB(titles, image, args.latency, args.errors)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    results = []
+    try:
+        sys.stderr.write("Generating %s ROMs in %s..\n" % (size, workdir))
+        home, roms, files, variants = makeLibrary(workdir, titles, size, args.rom_size)
+        for name, options in SCENARIOS:
+            if name not in scenarios:
+                continue
+            if name == 'incremental':
+                # 1% more ROMs than on the last run
+                files.extend(makeRoms(roms, titles, len(files), max(1, size // 100), args.rom_size))
+            # Matches picked by the previous scenario would skip matching
+            matches = os.path.join(home, ".emulationstation", "matches.json")
+            if os.path.exists(matches):
+                os.remove(matches)
+            sys.stderr.write("Running %s (%s ROMs)..\n" % (name, len(files)))
+            status, elapsed, systems = runScraper(server, home, workdir, "%s-%s" % (name, size), options)
+            results.append({
+                'scenario': name,
+                'roms': len(files),
+                'args': options,
+                'exit_status': status,
+                'seconds': round(elapsed, 3),
+                'roms_per_sec': round(len(files) / elapsed, 1) if elapsed else None,
+                'requests': dict(server.requests),
+                'bytes_served': server.sent,
+                'systems': systems,
+                'unmatched_variants': checkVariants(roms, variants),
+            })
+    finally:
+        server.shutdown()
+        server.server_close()
+        if args.keep:
+            sys.stderr.write("Work folder kept in %s\n" % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def main():
+    scenarios = args.scenarios.split(',')
+    unknown = set(scenarios) - set(s[0] for s in SCENARIOS)
+    if unknown:
+        sys.exit("Unknown scenarios: %s" % ", ".join(sorted(unknown)))
+    width, height = [int(v) for v in args.image_size.lower().split('x')]
+
+    titles = makeTitles(args.catalog)
+    image = makePNG(width, height)
+    results = []
+    for size in [int(s) for s in args.sizes.split(',')]:
+        results.extend(benchmark(size, titles, image, scenarios))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print output
+    if args.o:
+        with open(args.o, 'w') as f:
+            f.write(output + "\n")
+    # A run that scraped nothing measured nothing
+    failed = ["%s (%s ROMs): nothing added" % (r['scenario'], r['roms'])
+              for r in results if not sum(s.get('added', 0) for s in r['systems'])]
+    failed += ["%s (%s ROMs): %s not matched to their dashed title" % (r['scenario'], r['roms'], ", ".join(r['unmatched_variants']))
+               for r in results if r['unmatched_variants']]
+    if failed:
+        sys.exit("Benchmark failed:\n  " + "\n  ".join(failed))
+
+if __name__ == '__main__':
+    main()
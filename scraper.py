@@ -1,21 +1,61 @@
 #!/usr/bin/env python
 
 import argparse
-import difflib
-import Image
+import collections
+import contextlib
+import cProfile
+import ctypes
+import errno
+import fcntl
+import hashlib
+import httplib
 import imghdr
+import json
+import multiprocessing
 import os
+import pstats
+import Queue
+import random
 import re
 import readline
+import select
+import signal
+import socket
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
+import time
 import unicodedata
 import urllib
-import urllib2
+import urlparse
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 from xml.etree import ElementTree as ET
 from xml.etree.ElementTree import Element, SubElement
+import zipfile
 import zlib
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+# Set for the system being scanned, its ROMs are named after short names
 SCUMMVM = False
+ARCADE = False
 
 parser = argparse.ArgumentParser(description='ES-scraper, a scraper for EmulationStation')
 parser.add_argument("-w", metavar="pixels", help="defines a maximum width (in pixels) for boxarts (anything above that will be resized to that value)", type=int)
@@ -27,31 +67,378 @@ parser.add_argument("-f", help="force re-scraping (ignores and overwrites the cu
 parser.add_argument("-crc", help="CRC scraping", action='store_true')
 parser.add_argument("-p", help="partial scraping (per console)", action='store_true')
 parser.add_argument("-l", help="i'm feeling lucky (use first result)", action='store_true')
+parser.add_argument("-j", metavar="N", help="number of games fetched in parallel (only with -l or --queue)", type=int, default=1)
 parser.add_argument('-newpath', help="gamelist & boxart are written in $HOME/.emulationstation/%%NAME%%/", action='store_true')
 parser.add_argument('-fix', help="temporary thegamesdb missing platform fix", action='store_true')
+parser.add_argument('--rescan', help="read every ROM folder and check every file for changes, even in folders that look unchanged", action='store_true')
+parser.add_argument('--cache-dir', metavar="dir", help="directory for cached thegamesdb responses (default: $HOME/.emulationstation/cache/)")
+parser.add_argument('--cache-size', metavar="MB", help="maximum size of the response cache (default: 256)", type=int, default=256)
+parser.add_argument('--no-cache', help="disables the response cache", action='store_true')
+parser.add_argument('--cache-only', help="offline mode, only use cached responses (ignores expiry)", action='store_true')
+parser.add_argument('--timeout', metavar="secs", help="give up on a server not answering for this long (default: 30)", type=float, default=30)
+parser.add_argument('--retries', metavar="N", help="retries for timeouts, server errors and throttling (default: 3)", type=int, default=3)
+parser.add_argument('--rate', metavar="N", help="maximum requests per second to each server, split between the systems scanned with --systems-parallel (default: no limit)", type=float, default=0)
+parser.add_argument('--systems-parallel', metavar="N", help="number of systems scanned at the same time (only with -l or --queue)", type=int, default=1)
+parser.add_argument('--checkpoint', metavar="N", help="save gamelist.xml every N new games (default: 50)", type=int, default=50)
+parser.add_argument('--checkpoint-secs', metavar="T", help="save gamelist.xml at least every T seconds (default: 60)", type=int, default=60)
+parser.add_argument('--queue', help="don't ask for unclear matches, queue them for --review instead", action='store_true')
+parser.add_argument('--watch', help="keep running and scrape ROMs as soon as they are added or renamed (Linux only, with -l or --queue)", action='store_true')
+parser.add_argument('--refresh', metavar="fields", help="update these fields (e.g. rating,desc or image) of the games already in gamelist.xml, using their stored id")
+parser.add_argument('--review', help="pick matches for the games queued with --queue", action='store_true')
+parser.add_argument('--db', metavar="file", help="read game lists and game info from a catalog snapshot instead of thegamesdb")
+parser.add_argument('--export-db', metavar="file", help="save game lists and game info of all configured systems to a catalog snapshot and exit")
+parser.add_argument('--stats', metavar="file", nargs='?', const='-', help="print a JSON summary of the time spent on each stage per system (or append it to file)")
+parser.add_argument('--profile', metavar="file", help="run under cProfile and save the stats to file (main thread only)")
+parser.add_argument('--rematch', help="ignore the matches picked before, and replace them with the ones picked now", action='store_true')
+parser.add_argument('--export-matches', metavar="file", help="save the matches picked so far (by you or with -l) to file and exit")
+parser.add_argument('--import-matches', metavar="file", help="add matches saved with --export-matches and exit")
+parser.add_argument('--import-titles', metavar="file", help="import arcade titles from a MAME -listxml dump, or ScummVM titles from scummvm --list-games, and exit")
+parser.add_argument('--update-platforms', help="refresh the platform table from thegamesdb and exit", action='store_true')
 args = parser.parse_args()
 
-# URLs for retrieving from TheGamesDB API
-GAMESDB_BASE  = "http://thegamesdb.net/api/"
+# URLs for retrieving from TheGamesDB API (ES_SCRAPER_GAMESDB points them
+# at another server, e.g. the one from benchmark.py)
+GAMESDB_HOST  = os.environ.get('ES_SCRAPER_GAMESDB', "http://thegamesdb.net/")
+GAMESDB_BASE  = GAMESDB_HOST + "api/"
 PLATFORM_URL  = GAMESDB_BASE + "GetPlatform.php"
 GAMEINFO_URL  = GAMESDB_BASE + "GetGame.php"
 GAMESLIST_URL = GAMESDB_BASE + "GetGamesList.php"
+PLATFORMS_URL = GAMESDB_BASE + "GetPlatformsList.php"
+BANNERS_URL   = GAMESDB_HOST + "banners/"
 
 DEFAULT_WIDTH  = 375
 DEFAULT_HEIGHT = 350
 
+# How long (in seconds) cached responses stay fresh, per endpoint
+CACHE_TTL = {
+    PLATFORM_URL:  30*24*3600,
+    GAMESLIST_URL: 24*3600,
+    GAMEINFO_URL:  7*24*3600,
+}
+
+# Ignored when comparing titles
+TITLE_EXCLUDE = set(',:&!')
+COMMON_WORDS  = ['in','of','the','and','to','a','-']
+
+# Catalog titles are indexed by their fragments of this many characters.
+# Words are matched as regular expressions, those using any of these
+# characters can't be looked up that way.
+GRAM = 3
+PATTERN_CHARS = set('^$*+?{}[]\\|()')
+
+# Running size of the response cache (computed on first write)
+cache_size = None
+
+# Files written through mkstemp are made readable like any other file
+# (read here, as changing it is not thread safe)
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# Remote requests: keep-alive connections (per thread), and the rate and
+# concurrency limits of each server
+http_local = threading.local()
+host_lock = threading.Lock()
+host_limits = {}
+CONNECT_TIMEOUT = 10
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+RETRY_STATUS = (429, 500, 502, 503, 504)
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+# Requests this much slower than usual (and over SLOW_MIN seconds) mean
+# the server is struggling
+SLOW_FACTOR = 3
+SLOW_MIN = 0.5
+
+# Boxart downloads: what was downloaded into each boxart folder
+boxart_lock = threading.Lock()
+boxart_indexes = {}
+BOXART_INDEX = ".boxart-index.json"
+DOWNLOAD_CHUNK = 64*1024
+
+# Boxart processing: worker processes, pending jobs, and where processed
+# art is stored by hash of the downloaded image and target size (kept
+# next to es_systems.cfg, not in the response cache, which is trimmed)
+image_pool = None
+image_jobs = []
+image_lock = threading.Lock()
+image_index = None
+IMAGE_INDEX = "images.json"
+
+# Sidecar of gamelist.xml recording what each entry was scraped from
+MANIFEST = ".gamelist-manifest.json"
+
+# New entries of gamelist.xml not yet folded into it
+JOURNAL = ".gamelist-journal.xml"
+
+# Listing of every ROM folder as of its modification time, folders
+# modified this recently are read again next time (timestamps are coarse)
+FOLDER_INDEX = ".gamelist-folders.json"
+RECENT_MTIME = 2
+
+# With --watch, new files are scraped once left alone this long, and
+# systems whose game list couldn't be loaded are tried again later
+WATCH_SETTLE = 2
+WATCH_RETRY = 60
+
+# Set in worker processes by --systems-parallel, to report to the parent
+progress_queue = None
+PROGRESS_INTERVAL = 5
+
+# Output of each system scanned by --systems-parallel, next to
+# es_systems.cfg (the response cache is trimmed)
+LOGS = "logs"
+
+# gamelist.xml fields that --refresh can update
+REFRESH_FIELDS = ('name', 'desc', 'image', 'releasedate', 'publisher', 'developer', 'rating', 'genres')
+
+# Games left for --review, and how many options are kept for each
+REVIEW_QUEUE = ".review-queue.json"
+REVIEW_OPTIONS = 10
+
+# CRCs of ROM files, keyed by path, size and modification time. Kept
+# next to es_systems.cfg, not in the response cache, which is trimmed.
+CRC_CACHE = "crc.json"
+CRC_CHUNK = 1024*1024
+ARCHIVE_EXTENSIONS = ('.zip', '.7z', '.rar')
+
+# thegamesdb id picked for each platform and ROM title (or CRC), and
+# whether someone picked it or it was picked automatically. Kept next to
+# es_systems.cfg, not in the response cache, which is trimmed.
+MATCHES = "matches.json"
+match_decisions = None
+new_decisions = {}
+
+# Timings and cache counters of the system being scanned, for --stats
+stats_lock = threading.Lock()
+stage_stats = {}
+cache_stats = {}
+
+# Full title, year and manufacturer of arcade and ScummVM short names,
+# imported with --import-titles
+TITLES_FILE = "titles.json"
+title_tables = None
+
+# Known thegamesdb platforms (see README), overridden by platforms.cfg
+PLATFORMS = {
+    '1': "PC",
+    '2': "Nintendo GameCube",
+    '3': "Nintendo 64",
+    '4': "Nintendo Game Boy",
+    '5': "Nintendo Game Boy Advance",
+    '6': "Super Nintendo (SNES)",
+    '7': "Nintendo Entertainment System (NES)",
+    '8': "Nintendo DS",
+    '9': "Nintendo Wii",
+    '10': "Sony Playstation",
+    '11': "Sony Playstation 2",
+    '12': "Sony Playstation 3",
+    '13': "Sony PSP",
+    '14': "Microsoft Xbox",
+    '15': "Microsoft Xbox 360",
+    '16': "Sega Dreamcast",
+    '17': "Sega Saturn",
+    '18': "Sega Genesis",
+    '20': "Sega Game Gear",
+    '21': "Sega CD",
+    '22': "Atari 2600",
+    '23': "Arcade",
+    '24': "NeoGeo",
+    '25': "3DO",
+    '26': "Atari 5200",
+    '27': "Atari 7800",
+    '28': "Atari Jaguar",
+    '29': "Atari Jaguar CD",
+    '30': "Atari XE",
+    '31': "Colecovision",
+    '32': "Intellivision",
+    '33': "Sega 32X",
+    '34': "TurboGrafx 16",
+    '35': "Sega Master System",
+    '36': "Sega Mega Drive",
+    '37': "Mac OS",
+    '38': "Nintendo Wii U",
+    '39': "Sony Playstation Vita",
+    '40': "Commodore 64",
+    '41': "Nintendo Game Boy Color",
+    '4911': "Amiga",
+    '4912': "Nintendo 3DS",
+}
+
 # Used to signal user wants to manually define title from results
 class ManualTitleInterrupt(Exception):
     pass
 
+# Used to signal a game has no clear match while running with --queue
+class ReviewNeeded(Exception):
+    def __init__(self, options):
+        Exception.__init__(self, "no clear match")
+        self.options = options
+
+# Used to signal a response is not available offline (--cache-only, --db)
+class CacheMiss(Exception):
+    pass
+
+# Used to signal a failed request worth retrying (server error, throttling)
+class TransientError(IOError):
+    def __init__(self, message, retry_after=None):
+        IOError.__init__(self, message)
+        self.retry_after = retry_after
+
+class ResponseReader(object):
+    """File-like view of a response body, gunzipped on the fly, so it can
+    be parsed while it downloads. Keeps a copy of the body if asked to."""
+
+    def __init__(self, resp, keep=False):
+        self.resp = resp
+        gzipped = (resp.getheader('content-encoding') or '').lower() == 'gzip'
+        self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self.chunks = [] if keep else None
+        self.received = 0           # bytes on the wire
+        self.done = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(iter(lambda: self.read(DOWNLOAD_CHUNK), ''))
+        # Compressed chunks may decode to nothing yet, only '' means the end
+        while not self.done:
+            raw = self.resp.read(size)
+            self.received += len(raw)
+            if raw:
+                data = self.decoder.decompress(raw) if self.decoder else raw
+            else:
+                self.done = True
+                data = self.decoder.flush() if self.decoder else ''
+            if data:
+                if self.chunks is not None:
+                    self.chunks.append(data)
+                return data
+        return ''
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+class TokenBucket(object):
+    """Lets through rate requests per second on average, with bursts
+    of up to one second worth of them."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class AdaptiveLimit(object):
+    """Limit on requests in flight to a server (AIMD): grows by one for
+    every round of successful requests, and halves when requests time
+    out, get throttled or the server takes much longer than usual to
+    answer. Only the wait for the response headers counts, downloading
+    a large body or handling it says nothing about the server."""
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.inflight = 0
+        self.latency = None         # usual latency, slowly following changes
+        self.decreased = 0          # when the limit was last cut
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+        return time.time()
+
+    def release(self, started, latency, congested):
+        # latency is None when no response came back
+        now = time.time()
+        with self.cond:
+            self.inflight -= 1
+            if latency is not None:
+                if self.latency is not None and latency > max(self.latency*SLOW_FACTOR, SLOW_MIN):
+                    congested = True
+                self.latency = latency if self.latency is None else self.latency*0.95 + latency*0.05
+            if congested:
+                # Requests sent before the last cut saw the same conditions,
+                # they don't count again
+                if started >= self.decreased:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreased = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+def resetStats():
+    with stats_lock:
+        stage_stats.clear()
+        cache_stats.clear()
+
+def recordStage(stage, seconds, size=0):
+    with stats_lock:
+        times, total = stage_stats.get(stage, ([], 0))
+        times.append(seconds)
+        stage_stats[stage] = (times, total + size)
+
+def recordCache(cache, hit):
+    with stats_lock:
+        counts = cache_stats.setdefault(cache, [0, 0])
+        counts[0 if hit else 1] += 1
+
+@contextlib.contextmanager
+def timedStage(stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        recordStage(stage, time.time() - start)
+
+def percentile(times, q):
+    # Nearest rank on an already sorted list
+    return times[min(len(times)-1, int(q*len(times)))]
+
+def statsSummary(name, **counts):
+    with stats_lock:
+        stages = {}
+        for stage, (times, size) in stage_stats.items():
+            times = sorted(times)
+            stages[stage] = {'count': len(times), 'total': round(sum(times), 4),
+                             'p50': round(percentile(times, 0.5), 4),
+                             'p95': round(percentile(times, 0.95), 4), 'bytes': size}
+        caches = {}
+        for cache, (hits, misses) in cache_stats.items():
+            caches[cache] = {'hits': hits, 'misses': misses,
+                             'hit_rate': round(float(hits) / (hits + misses), 4)}
+    summary = dict(counts, system=name, stages=stages, caches=caches)
+    return json.dumps(summary, sort_keys=True)
+
+def emitStats(summary):
+    if args.stats == '-':
+        print summary
+        return
+    # One line per system, whole lines so parallel systems don't interleave
+    fd = os.open(args.stats, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, summary + "\n")
+    finally:
+        os.close(fd)
+
 def normalize(s):
    return ''.join((c for c in unicodedata.normalize('NFKD', unicode(s)) if unicodedata.category(c) != 'Mn'))
 
-def fixExtension(file):
-    newfile = "%s.%s" % (os.path.splitext(file)[0],imghdr.what(file))
-    os.rename(file, newfile)
-    return newfile
-
 def readConfig(file):
     lines = config.read().splitlines()
     systems = []
@@ -77,10 +464,124 @@ def readConfig(file):
 
 def crc(fileName):
     prev = 0
-    for eachLine in open(fileName,"rb"):
-        prev = zlib.crc32(eachLine, prev)
+    with open(fileName, "rb") as f:
+        for chunk in iter(lambda: f.read(CRC_CHUNK), ''):
+            prev = zlib.crc32(chunk, prev)
     return "%X" % (prev & 0xFFFFFFFF)
 
+def hashFile(fileName):
+    try:
+        return crc(fileName)
+    except IOError as e:
+        print "Can't read %s: %s" % (fileName, e.strerror)
+        return None
+
+def zipCrc(fileName, extensions):
+    # The central directory already holds each member's CRC, so there is
+    # nothing to decompress. Pick the ROM by extension, else the largest.
+    try:
+        with zipfile.ZipFile(fileName) as archive:
+            members = [m for m in archive.infolist() if not m.filename.endswith('/')]
+    except (IOError, zipfile.BadZipfile) as e:
+        print "Can't read %s: %s" % (fileName, e)
+        return None
+    roms = [m for m in members if m.filename.lower().endswith(extensions)]
+    if not roms:
+        roms = members
+    if not roms:
+        return None
+    return "%X" % (max(roms, key=lambda m: m.file_size).CRC & 0xFFFFFFFF)
+
+def crcFile():
+    return os.environ['HOME']+"/.emulationstation/"+CRC_CACHE
+
+def crcFiles(paths, extensions):
+    # Files unchanged since they were last hashed are never read again
+    cachefile = crcFile()
+    try:
+        with open(cachefile) as f:
+            known = json.load(f)
+    except (IOError, ValueError):
+        known = {}
+
+    crcs = {}
+    todo = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stat = [st.st_size, st.st_mtime]
+        old = known.get(path)
+        if old is not None and old[:2] == stat:
+            crcs[path] = old[2]
+        else:
+            todo.append((path, stat))
+        recordCache('crc', old is not None and old[:2] == stat)
+    # Zipped ROMs are resolved straight from the archive directory
+    extensions = tuple(e.lower() for e in extensions if e and e.lower() not in ARCHIVE_EXTENSIONS)
+    hashed = []
+    for path, stat in todo:
+        if path.lower().endswith('.zip'):
+            hashed.append((path, stat, zipCrc(path, extensions)))
+    todo = [(path, stat) for path, stat in todo if not path.lower().endswith('.zip')]
+
+    if todo:
+        print "Computing CRC of %s files.." % len(todo)
+    start = time.time()
+    # Worker processes of --systems-parallel can't start a pool of their own
+    if len(todo) > 1 and not multiprocessing.current_process().daemon:
+        pool = multiprocessing.Pool()
+        try:
+            # map_async so Ctrl+C still gets through while waiting
+            hashes = pool.map_async(hashFile, [path for path, stat in todo], chunksize=1).get(999999)
+        except KeyboardInterrupt:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+    else:
+        hashes = [hashFile(path) for path, stat in todo]
+    hashed.extend((path, stat, value) for (path, stat), value in zip(todo, hashes))
+    recordStage('crc', time.time() - start, sum(stat[0] for path, stat in todo))
+    if not hashed:
+        return crcs
+
+    # Other systems may be hashing at the same time, merge with their results
+    with lockedFile(cachefile):
+        try:
+            with open(cachefile) as f:
+                known = json.load(f)
+        except (IOError, ValueError):
+            pass
+        for path, stat, value in hashed:
+            if value is not None:
+                crcs[path] = value
+                known[path] = stat + [value]
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cachefile))
+        shareFile(fd)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(known, f)
+        os.rename(tmp, cachefile)
+    return crcs
+
+def shareFile(fd):
+    # mkstemp creates files readable by their owner only
+    os.fchmod(fd, 0o666 & ~UMASK)
+
+@contextlib.contextmanager
+def lockedFile(path):
+    # Held while reading, merging and replacing a file that other
+    # processes update too, so none of their changes are lost
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
 def indent(elem, level=0):
     i = "\n" + level*"  "
     if len(elem):
@@ -96,102 +597,692 @@ def indent(elem, level=0):
         if level and (not elem.tail or not elem.tail.strip()):
             elem.tail = i
 
+def cachePath(url, params):
+    # Entries are addressed by a hash of the endpoint and its parameters
+    key = hashlib.sha1(url + '?' + urllib.urlencode(sorted(params.items()))).hexdigest()
+    return os.path.join(args.cache_dir, key[:2], key)
+
+def readCache(url, params):
+    path = cachePath(url, params)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    # Stale entries are still good enough when working offline
+    if not args.cache_only and time.time() - st.st_mtime > CACHE_TTL.get(url, 0):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        # Evicted by another thread in the meantime
+        return None
+    # Access time tracks LRU order, modification time tracks expiry
+    os.utime(path, (time.time(), st.st_mtime))
+    return data
+
+def writeCache(url, params, data):
+    global cache_size
+    path = cachePath(url, params)
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    fd, tmp = tempfile.mkstemp(dir=folder)
+    shareFile(fd)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+    if cache_size is None:
+        cache_size = sum(e[1] for e in cacheEntries())
+    else:
+        cache_size += len(data)
+    if cache_size > args.cache_size*1024*1024:
+        evictCache()
+
+def cacheEntries():
+    # Only responses (laid out by cachePath) count towards the limit and
+    # are evicted, anything else in the folder is left alone
+    entries = []
+    for prefix in os.listdir(args.cache_dir):
+        folder = os.path.join(args.cache_dir, prefix)
+        if len(prefix) != 2 or not os.path.isdir(folder):
+            continue
+        for f in os.listdir(folder):
+            if len(f) != 40 or not f.startswith(prefix):
+                continue
+            path = os.path.join(folder, f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_atime, st.st_size, path))
+    return entries
+
+def evictCache():
+    # Drop least recently used entries until we are 10% under the limit
+    global cache_size
+    entries = sorted(cacheEntries())
+    cache_size = sum(e[1] for e in entries)
+    limit = args.cache_size*1024*1024*0.9
+    for atime, size, path in entries:
+        if cache_size <= limit:
+            break
+        try:
+            os.remove(path)
+            cache_size -= size
+        except OSError:
+            pass
+    if args.v:
+        print "Response cache trimmed to %s bytes" % cache_size
+
+def parseXML(f):
+    return ET.parse(f).getroot()
+
+def fetchXML(url, params, parse=parseXML, fresh=False):
+    # parse turns the response (a file) into the result, the root element
+    # by default. Downloads are parsed as they arrive. fresh skips the
+    # cached response, unless working offline.
+    if args.db:
+        raise CacheMiss("%s (%s) is not in %s" % (url, urllib.urlencode(params), args.db))
+    if not args.no_cache and (args.cache_only or not fresh):
+        data = readCache(url, params)
+        recordCache('response', data is not None)
+        if data is not None:
+            return parse(StringIO(data))
+        if args.cache_only:
+            raise CacheMiss("%s (%s) is not cached" % (url, urllib.urlencode(params)))
+
+    def receive(resp):
+        if resp.status != 200:
+            resp.read()
+            raise IOError("HTTP %s %s (%s)" % (resp.status, resp.reason, url))
+        body = ResponseReader(resp, keep=not args.no_cache)
+        result = parse(body)
+        # Whatever the parser left, so the connection can be reused
+        while body.read(DOWNLOAD_CHUNK):
+            pass
+        return result, body
+
+    start = time.time()
+    result, body = request(url, urllib.urlencode(params), {'Accept-Encoding': "gzip"}, receive)
+    recordStage('api', time.time() - start, body.received)
+    # Only cached once parsed, so malformed responses are never stored
+    if not args.no_cache:
+        writeCache(url, params, body.getvalue())
+    return result
+
+def platformsFile():
+    return os.environ['HOME']+"/.emulationstation/platforms.cfg"
+
+def loadPlatforms():
+    try:
+        with open(platformsFile()) as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return
+    for line in lines:
+        if not line.strip() or line[0]=='#' or '=' not in line:
+            continue
+        pid, name = line.split('=', 1)
+        PLATFORMS[pid.strip()] = name.strip()
+
+def updatePlatforms():
+    platforms = ET.fromstring(fetchURL(PLATFORMS_URL)).findall('Platforms/Platform')
+    if not platforms:
+        sys.exit("No platforms returned by %s" % PLATFORMS_URL)
+    with open(platformsFile(), 'w') as f:
+        f.write("# Platform table, regenerate with --update-platforms\n")
+        for p in sorted(platforms, key=lambda p: int(p.findtext('id'))):
+            f.write(("%s=%s\n" % (p.findtext('id'), p.findtext('name'))).encode('utf-8'))
+    print "%s platforms saved on %s" % (len(platforms), platformsFile())
+
+def titlesFile():
+    return os.environ['HOME']+"/.emulationstation/"+TITLES_FILE
+
+def loadTitles():
+    global title_tables
+    if title_tables is None:
+        try:
+            with open(titlesFile()) as f:
+                title_tables = json.load(f)
+        except (IOError, ValueError):
+            title_tables = {}
+    return title_tables
+
+def readMameTitles(f):
+    # Streamed, full -listxml dumps are hundreds of MB
+    titles = {}
+    for machine in streamGamelist(f):
+        # <game> in dumps of MAME before 0.162
+        if machine.tag not in ('machine', 'game') or 'yes' in (machine.get('isdevice'), machine.get('isbios')):
+            continue
+        titles[machine.get('name')] = [machine.findtext('description'), machine.findtext('year'),
+                                       machine.findtext('manufacturer')]
+    return titles
+
+def readScummvmTitles(f):
+    # A header, then one "[engine:]id  title" line per game
+    titles = {}
+    for line in f:
+        line = line.decode('utf-8').strip()
+        if not line or line.startswith('Game ID') or line.startswith('-'):
+            continue
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            titles[parts[0].split(':')[-1]] = [parts[1], None, None]
+    return titles
+
+def importTitles(path):
+    with open(path, 'rb') as f:
+        isxml = f.read(1024).lstrip().startswith('<')
+        f.seek(0)
+        if isxml:
+            kind, titles = 'arcade', readMameTitles(f)
+        else:
+            kind, titles = 'scummvm', readScummvmTitles(f)
+    if not titles:
+        sys.exit("No titles found in %s" % path)
+    # A new dump replaces the previous table of its kind
+    tables = loadTitles()
+    tables[kind] = titles
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(titlesFile()))
+    shareFile(fd)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(tables, f)
+    os.rename(tmp, titlesFile())
+    print "%s %s titles saved on %s" % (len(titles), kind, titlesFile())
+
+def setSystemKind(name, platformID):
+    global SCUMMVM, ARCADE
+    SCUMMVM = name == "scummvm"
+    ARCADE = PLATFORMS.get(platformID.strip()) == "Arcade"
+
 def getPlatformName(id):
-    req = urllib2.Request(PLATFORM_URL, urllib.urlencode({'id': id}),
-                          headers={'User-Agent' : "RetroPie Scraper Browser"})
-    data = urllib2.urlopen( req )
-    platform_data = ET.parse(data)
-    return platform_data.find('Platform/Platform').text
-
-def exportList(gamelist):
-    if gamelistExists and args.f is False:
-        for game in gamelist.iter("game"):
-            existinglist.getroot().append(game)
-
-        indent(existinglist.getroot())
-        ET.ElementTree(existinglist.getroot()).write("gamelist.xml")
-        print "Done! %s updated." % os.getcwd()+"/gamelist.xml"
+    id = id.strip()
+    if id not in PLATFORMS:
+        platform_data = fetchXML(PLATFORM_URL, {'id': id})
+        PLATFORMS[id] = platform_data.find('Platform/Platform').text
+    return PLATFORMS[id]
+
+class GamelistWriter(object):
+    """Appends scraped games to a journal and periodically folds it into
+    gamelist.xml, so an interrupted run only loses the last few games."""
+
+    def __init__(self, replace=False):
+        self.replace = replace      # drop the existing entries (-f)
+        self.paths = set()          # games in the journal, replacing older entries
+        self.added = 0
+        self.pending = 0
+        self.last = time.time()
+        self.journal = open(JOURNAL, 'ab')
+
+    def add(self, game):
+        start = time.time()
+        indent(game, 1)
+        game.tail = None
+        self.journal.write(ET.tostring(game) + "\n")
+        self.journal.flush()
+        self.paths.add(game.findtext("path"))
+        self.added += 1
+        self.pending += 1
+        if self.pending >= args.checkpoint or time.time() - self.last >= args.checkpoint_secs:
+            self.commit()
+        recordStage('write', time.time() - start)
+
+    def commit(self):
+        commitGamelist(self.paths, self.replace)
+        self.journal.truncate(0)
+        self.paths.clear()
+        self.replace = False
+        self.pending = 0
+        self.last = time.time()
+
+    def close(self):
+        if self.pending:
+            with timedStage('write'):
+                self.commit()
+        self.journal.close()
+        os.remove(JOURNAL)
+
+def streamGamelist(file):
+    # Yield the entries of a gamelist one by one without keeping the tree
+    root = None
+    depth = 0
+    for event, elem in ET.iterparse(file, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            yield elem
+            root.clear()
+
+def readJournal():
+    with open(JOURNAL, 'rb') as f:
+        data = f.read()
+    # A crash may have cut the last entry short
+    end = data.rfind("</game>")
+    if end < 0:
+        return []
+    return list(ET.fromstring("<journal>%s</journal>" % data[:end+7]))
+
+def writeEntry(out, entry):
+    indent(entry, 1)
+    entry.tail = None
+    out.write("\n  " + ET.tostring(entry))
+
+def commitGamelist(replaced, dropExisting):
+    # Merge the current gamelist.xml and the journal into a temporary file,
+    # sync it to disk and swap it in
+    fd, tmp = tempfile.mkstemp(dir=".")
+    shareFile(fd)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write("<gameList>")
+            journal = collections.OrderedDict((e.findtext("path"), e) for e in readJournal())
+            if not dropExisting and os.path.exists("gamelist.xml"):
+                for entry in streamGamelist("gamelist.xml"):
+                    if entry.tag != "game" or entry.findtext("path") not in replaced:
+                        writeEntry(out, entry)
+                    elif entry.findtext("path") in journal:
+                        # Updated games keep their place
+                        writeEntry(out, journal.pop(entry.findtext("path")))
+            for entry in journal.values():
+                writeEntry(out, entry)
+            out.write("\n</gameList>\n")
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(tmp, "gamelist.xml")
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    folder = os.open(".", os.O_RDONLY)
+    try:
+        os.fsync(folder)
+    finally:
+        os.close(folder)
+
+def listFolder(path):
+    # Files and subfolders (symlinks followed), like os.walk sorts them
+    files = []
+    folders = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                isdir = entry.is_dir()
+            except OSError:
+                isdir = False
+            (folders if isdir else files).append(entry.name)
     else:
-        indent(gamelist)
-        ET.ElementTree(gamelist).write("gamelist.xml")
-        print "Done! List saved on %s" % os.getcwd()+"/gamelist.xml"
-
-def getFiles(base):
-    dict = set([])
-    for files in sorted(os.listdir(base)):
-        if files.endswith(tuple(ES_systems[var][2].split(' '))):
-            filepath = os.path.abspath(os.path.join(base, files))
-            dict.add(filepath)
-    return dict
-
-def getPlatformGameList(platformID):
-    platform = getPlatformName(platformID)
-    gamelist = urllib2.Request(GAMESLIST_URL, urllib.urlencode({'platform' : platform}),
-                               headers={'User-Agent' : "RetroPie Scraper Browser"})
-    return ET.parse(urllib2.urlopen(gamelist)).getroot()
+        for name in os.listdir(path):
+            (folders if os.path.isdir(os.path.join(path, name)) else files).append(name)
+    return files, folders
+
+def walkRoms(folder, extensions, index, newindex):
+    # Yields (root, matching files, unchanged) for folder and everything
+    # below it, following symlinks. Folders not modified since the last
+    # scan come from index instead of being read again, and the listings
+    # for next time are stored in newindex.
+    pending = [(folder, ())]
+    while pending:
+        root, parents = pending.pop()
+        try:
+            st = os.stat(root)
+        except OSError:
+            continue
+        key = (st.st_dev, st.st_ino)
+        if key in parents:
+            print "Skipping %s, symlink loop.." % root
+            continue
 
-def getGameInfo(file, platformID, gamelist):
-    title = re.sub(r'\[.*?\]|\(.*?\)', '', os.path.splitext(os.path.basename(file))[0]).strip()
-    results = gamelist.findall('Game')
-    options = []
+        known = index.get(root)
+        unchanged = known is not None and known[0] == st.st_mtime
+        if unchanged:
+            files, folders = known[1], known[2]
+        else:
+            try:
+                files, folders = listFolder(root)
+            except OSError:
+                continue
+            files = sorted(f for f in files if f.endswith(extensions))
+            folders.sort()
+        if time.time() - st.st_mtime > RECENT_MTIME:
+            newindex[root] = [st.st_mtime, files, folders]
+
+        yield root, files, unchanged
+        pending.extend((os.path.join(root, f), parents + (key,)) for f in reversed(folders))
+
+def snapshotDB(path):
+    # sqlite connections can't be shared between threads
+    conns = http_local.__dict__.setdefault('dbs', {})
+    if path not in conns:
+        conns[path] = sqlite3.connect(path)
+        conns[path].text_factory = str
+    return conns[path]
+
+def createSnapshot(path):
+    db = snapshotDB(path)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS platforms (id TEXT PRIMARY KEY, name TEXT);
+        CREATE TABLE IF NOT EXISTS games (id TEXT, platform TEXT, title TEXT, normtitle TEXT,
+                                          listing TEXT, info TEXT, PRIMARY KEY (id, platform));
+        CREATE INDEX IF NOT EXISTS games_platform ON games (platform);
+        CREATE INDEX IF NOT EXISTS games_normtitle ON games (normtitle);
+        CREATE INDEX IF NOT EXISTS games_id ON games (id);
+    """)
+    return db
+
+def exportSnapshot(path):
+    db = createSnapshot(path)
+    pool = ThreadPool(max(args.j, 1))
+    done = set()
+    failed = []
+    for system in ES_systems:
+        platformID = system[3].strip()
+        if platformID in done:
+            continue
+        done.add(platformID)
 
-    def stripRegionStrings(title):
-        # Strip out parens matching certain strings
-        #  e.g.  (Rev 1), (World), (USA, Japan)
-        region_match = '^\((?:Rev|USA|Japan|France|Europe|World|En,)'
-        parens = re.findall('(\(.*?\))', title)
-        for p in parens:
-            if re.match(region_match, p) is not None:
-                title = title.replace(' %s' % p, '')
-        return title
+        try:
+            platform = getPlatformName(platformID)
+            games = fetchXML(GAMESLIST_URL, {'platform' : platform}).findall('Game')
+        except Exception as e:
+            print "Skipping platform %s, game list not available: %s" % (platformID, e)
+            failed.append(platformID)
+            continue
+        print "Exporting %s games for %s.." % (len(games), platform)
 
-    def getTitleOptions(title, results):
-        options = []
-        ch_exclude = set(',:&!')
-        common_words = ['in','of','the','and','to','a','-']
-
-        scrubbed_title = stripRegionStrings(title)
-        scrubbed_title = ''.join(ch for ch in scrubbed_title if ch not in ch_exclude)
-
-        word_list = filter(lambda x: x.lower() not in common_words \
-                              and len(x) > 2, scrubbed_title.split() )
-
-        for i,v in enumerate(results):
-            check_title = getTitle(v)
-            check_title_2 = check_title.replace('-', ' ')
-            scrubbed_check = ''.join(ch for ch in check_title if ch not in ch_exclude)
-
-            check_word_list = filter(lambda x: x.lower() not in common_words \
-                                        and len(x) > 2, scrubbed_check.split() )
-
-            # Generate rank based on how many substring matches occurred.
-            game_rank = 0
-
-            # - Give perfect (100) rank to titles that match exactly
-            if title.lower() == check_title.lower() \
-                    or title.lower() == check_title.replace('-', '').lower() \
-                    or title.lower() == check_title_2.lower():
-                game_rank = 100
-            # - Give high (99) rank to title if same words appear in result
-            #   (e.g.  "The Legend of Zelda" --> "Legend of Zelda, The"
-            elif sorted(word_list) == sorted(check_word_list):
-                game_rank = 99
-            # - Give high (95) rank to titles that appear entirely in results
-            elif title.lower() in check_title.lower() \
-                    or title.lower() in check_title.replace('-', '').lower() \
-                    or title.lower() in check_title_2.lower():
-                game_rank = 95
-            # - Otherwise, rank title by number of occurrences of words
-            else:
-                game_rank = len( re.findall("(%s)" % '|'.join(word_list), check_title) )
-            if game_rank:
-                options.append((game_rank, getTitle(v), getGamePlatform(v), getId(v)))
-        return options
+        def fetchInfo(game):
+            try:
+                return ET.tostring(fetchXML(GAMEINFO_URL, {'id': game.findtext('id'), 'platform' : platform}))
+            except Exception as e:
+                print "No game info for %s: %s" % (game.findtext('GameTitle'), e)
+                return None
+
+        db.execute("INSERT OR REPLACE INTO platforms VALUES (?, ?)", (platformID, platform))
+        db.execute("DELETE FROM games WHERE platform = ?", (platform,))
+        # Rows are inserted in catalog order, which is kept when reading back
+        for game, info in zip(games, pool.map(fetchInfo, games, chunksize=1)):
+            title = game.findtext('GameTitle') or ''
+            db.execute("INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?, ?)",
+                       (game.findtext('id'), platform, title, normalize(title).lower(),
+                        ET.tostring(game), info))
+        db.commit()
+    pool.close()
+    pool.join()
+    print "Done! Catalog snapshot saved on %s" % os.path.abspath(path)
+    if failed:
+        print "Platforms left out, run again to add them: %s" % ", ".join(failed)
+
+def loadSnapshotPlatforms():
+    for pid, name in snapshotDB(args.db).execute("SELECT id, name FROM platforms"):
+        PLATFORMS[pid] = name.decode('utf-8')
+
+def loadCatalog(platform):
+    # The platform's game list, indexed for matching. Games are parsed one
+    # at a time and dropped once indexed, the whole tree never exists.
+    if args.db:
+        rows = snapshotDB(args.db).execute("SELECT listing FROM games WHERE platform = ? ORDER BY rowid",
+                                           (platform,)).fetchall()
+        if not rows:
+            raise CacheMiss("%s is not in %s" % (platform, args.db))
+        return indexCatalog(ET.fromstring(row[0]) for row in rows)
+    return fetchXML(GAMESLIST_URL, {'platform' : platform},
+                    lambda f: indexCatalog(streamGamelist(f)))
+
+def titleWords(title):
+    # Significant words of a title, used for ranking matches
+    scrubbed = ''.join(ch for ch in title if ch not in TITLE_EXCLUDE)
+    return [x for x in scrubbed.split() if x.lower() not in COMMON_WORDS and len(x) > 2]
+
+def titleGrams(text):
+    return set(text[i:i+GRAM] for i in range(len(text) - GRAM + 1))
+
+def indexCatalog(games):
+    # Tokenize the platform catalog once: every game with its precomputed
+    # title variants, plus token -> games and fragment -> games indexes
+    # (of all the variants) to find candidates. Identical strings
+    # (variants without dashes, platform names, words) are stored once.
+    entries = []
+    tokens = collections.defaultdict(list)
+    grams = collections.defaultdict(list)
+    shared = {}
+    for v in games:
+        if v.tag != 'Game':
+            continue
+        title = getTitle(v)
+        if title is None:
+            continue
+        words = tuple(shared.setdefault(w, w) for w in sorted(titleWords(title)))
+        for word in set(w.lower() for w in words):
+            tokens[word].append(len(entries))
+        lower = title.lower()
+        if '-' in lower:
+            nodash, spaced = lower.replace('-', ''), lower.replace('-', ' ')
+        else:
+            nodash = spaced = lower
+        for gram in titleGrams(lower) | titleGrams(nodash) | titleGrams(spaced):
+            grams[gram].append(len(entries))
+        platform = getGamePlatform(v)
+        entries.append((title, lower, nodash, spaced, words,
+                        shared.setdefault(platform, platform), getId(v)))
+    return (entries, dict((token, tuple(ids)) for token, ids in tokens.iteritems()),
+            dict((gram, tuple(ids)) for gram, ids in grams.iteritems()))
+
+def containing(grams, text):
+    # Games with text in one of their title variants (and maybe a few
+    # more), or None if text is too short to be looked up
+    text = text.lower()
+    if len(text) < GRAM:
+        return None
+    if isinstance(text, str):
+        try:
+            text.decode('ascii')
+        except UnicodeDecodeError:
+            return None
+    postings = sorted((grams.get(gram, ()) for gram in titleGrams(text)), key=len)
+    found = set(postings[0])
+    for ids in postings[1:]:
+        if not found:
+            break
+        found.intersection_update(ids)
+    return found
+
+def catalogCandidates(catalog, title, words):
+    # Only games with the whole title in one of their variants, with the
+    # same words, or matching one of the words can rank above 0 (see
+    # findGame). Anything that can't be looked up falls back to all games.
+    entries, tokens, grams = catalog
+    if not words:
+        return entries
+    found = containing(grams, title)
+    if found is None:
+        return entries
+    for word in set(words):
+        found.update(tokens.get(word.lower(), ()))
+        if set(word) & PATTERN_CHARS:
+            return entries
+        # '.' matches any character, the text around it must be there
+        ids = containing(grams, max(word.split('.'), key=len))
+        if ids is None:
+            return entries
+        found.update(ids)
+    return [entries[i] for i in sorted(found)]
+
+def romTitle(file):
+    title = os.path.splitext(os.path.basename(file))[0]
+    # Arcade and ScummVM ROMs are named after short names (sf2, monkey)
+    if SCUMMVM:
+        title = getScummvmTitle(title)
+    elif ARCADE:
+        title = getRealArcadeTitle(title)
+    return re.sub(r'\[.*?\]|\(.*?\)', '', title).strip()
+
+def matchKey(file, platformID, crc=None):
+    # Regional versions and other dumps of a game share its title
+    if crc:
+        return "%s:crc:%s" % (platformID.strip(), crc)
+    return "%s:title:%s" % (platformID.strip(), normalize(romTitle(file)).lower())
+
+def readMatches(path):
+    try:
+        with open(path) as f:
+            return json.load(f)['matches']
+    except (IOError, ValueError, KeyError, TypeError):
+        return {}
+
+def writeMatches(path, matches):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    shareFile(fd)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'version': 1, 'matches': matches}, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+
+def mergeMatches(matches, new):
+    # A match picked by someone is never replaced by an automatic one
+    for key, match in new.iteritems():
+        old = matches.get(key)
+        if old is None or match['manual'] or not old['manual']:
+            matches[key] = match
+
+def matchesFile():
+    return os.environ['HOME']+"/.emulationstation/"+MATCHES
+
+def loadMatches():
+    global match_decisions
+    if match_decisions is None:
+        match_decisions = readMatches(matchesFile())
+    return match_decisions
+
+def saveMatches():
+    if not new_decisions:
+        return
+    # Other systems may be matching at the same time
+    path = matchesFile()
+    with lockedFile(path):
+        matches = readMatches(path)
+        if args.rematch:
+            matches.update(new_decisions)
+        else:
+            mergeMatches(matches, new_decisions)
+        writeMatches(path, matches)
+    new_decisions.clear()
+
+def knownMatch(key):
+    # Automatic matches are only reused when not asking anyway
+    if args.rematch:
+        return None
+    match = loadMatches().get(key)
+    if match is None or not (match['manual'] or args.l or args.queue):
+        return None
+    return (100, match['title'], None, match['id'])
+
+def rememberMatch(key, result, manual):
+    match = {key: {'id': result[3], 'title': result[1], 'manual': manual}}
+    if args.rematch:
+        # Even a match someone picked is replaced
+        loadMatches().update(match)
+        new_decisions.update(match)
+        return
+    mergeMatches(loadMatches(), match)
+    mergeMatches(new_decisions, match)
+
+def exportMatches(path):
+    matches = readMatches(matchesFile())
+    writeMatches(path, matches)
+    print "%s matches saved on %s" % (len(matches), os.path.abspath(path))
+
+def importMatches(path):
+    matches = readMatches(path)
+    if not matches:
+        sys.exit("No matches found in %s" % path)
+    mergeMatches(new_decisions, matches)
+    saveMatches()
+    print "%s matches imported from %s" % (len(matches), path)
+
+def matchGame(file, platformID, catalog, crc=None):
+    # findGame, unless a match was picked before for the same title (or CRC)
+    key = matchKey(file, platformID, crc)
+    result = knownMatch(key)
+    recordCache('match', result is not None)
+    if result is not None:
+        if args.v:
+            print "Using the match picked before: %s" % result[1]
+        return result
+    result = findGame(file, catalog)
+    if result is not None:
+        rememberMatch(key, result, not (args.l or args.queue))
+    return result
+
+def stripRegionStrings(title):
+    # Strip out parens matching certain strings
+    #  e.g.  (Rev 1), (World), (USA, Japan)
+    region_match = '^\((?:Rev|USA|Japan|France|Europe|World|En,)'
+    parens = re.findall('(\(.*?\))', title)
+    for p in parens:
+        if re.match(region_match, p) is not None:
+            title = title.replace(' %s' % p, '')
+    return title
+
+def getTitleOptions(title, catalog):
+    options = []
+    word_list = titleWords(stripRegionStrings(title))
+    words_re = re.compile("(%s)" % '|'.join(word_list))
+    sorted_words = tuple(sorted(word_list))
+    lower_title = title.lower()
+
+    for check in catalogCandidates(catalog, title, word_list):
+        check_title, check_lower, check_nodash, check_spaced, check_word_list, platform, id = check
+
+        # Generate rank based on how many substring matches occurred.
+        game_rank = 0
+
+        # - Give perfect (100) rank to titles that match exactly
+        if lower_title == check_lower \
+                or lower_title == check_nodash \
+                or lower_title == check_spaced:
+            game_rank = 100
+        # - Give high (99) rank to title if same words appear in result
+        #   (e.g.  "The Legend of Zelda" --> "Legend of Zelda, The"
+        elif sorted_words == check_word_list:
+            game_rank = 99
+        # - Give high (95) rank to titles that appear entirely in results
+        elif lower_title in check_lower \
+                or lower_title in check_nodash \
+                or lower_title in check_spaced:
+            game_rank = 95
+        # - Otherwise, rank title by number of occurrences of words
+        else:
+            game_rank = len( words_re.findall(check_title) )
+        if game_rank:
+            options.append((game_rank, check_title, platform, id))
+    return options
+
+def searchTitle(file, title, catalog):
+    # Allow user to re-enter name of game title (manual search)
+    readline.set_startup_hook(lambda: readline.insert_text(title))
+    try:
+        new_title = raw_input("Enter new title: ")
+    finally:
+        readline.set_startup_hook()
+    print " ~ Searching for '%s' [%s]..." % (new_title, os.path.basename(file))
+    return sorted(getTitleOptions(new_title, catalog),
+                  key=lambda x: (-x[0], x[1]))
+
+def findGame(file, catalog):
+    title = romTitle(file)
+    entries = catalog[0]
+    options = []
 
     # Search for matching title options
-    if len(results) > 1:
-        options = sorted(getTitleOptions(title, results),
-                         key=lambda x: (-x[0], x[1]))
+    if len(entries) > 1:
+        with timedStage('match'):
+            options = sorted(getTitleOptions(title, catalog),
+                             key=lambda x: (-x[0], x[1]))
 
     result = None
     while not result:
@@ -202,6 +1293,13 @@ def getGameInfo(file, platformID, gamelist):
             result = options[0]
             continue
 
+        # * Queue mode - only take a single perfect match, leave the rest
+        #   for --review
+        if args.queue and not args.review:
+            if options and options[0][0] == 100 and (len(options) == 1 or options[1][0] < 100):
+                return options[0]
+            raise ReviewNeeded(options[:REVIEW_OPTIONS])
+
         try:
             choice = chooseResult(options)
             if choice is None:
@@ -211,27 +1309,24 @@ def getGameInfo(file, platformID, gamelist):
         except KeyboardInterrupt:
             raise KeyboardInterrupt
         except ManualTitleInterrupt:
-            # Allow user to re-enter name of game title (manual search)
-            readline.set_startup_hook(lambda: readline.insert_text(title))
-            try:
-                new_title = raw_input("Enter new title: ")
-            finally:
-                readline.set_startup_hook()
-            print " ~ Searching for '%s' [%s]..." % (new_title, os.path.basename(file))
-            options = sorted(getTitleOptions(new_title, results),
-                             key=lambda x: (-x[0], x[1]))
+            options = searchTitle(file, title, catalog)
         except Exception as e:
             print "Invalid selection (%s) " % e
+    return result
 
+def getGameData(gameID, platform, fresh=False):
     # Retrieve full game data using ID
-    platform = getPlatformName(platformID)
+    if args.db:
+        row = snapshotDB(args.db).execute("SELECT info FROM games WHERE id = ? AND platform = ?",
+                                          (gameID, platform)).fetchone()
+        if row is None or row[0] is None:
+            print "No game info for %s in %s, skipping game.." % (gameID, args.db)
+            return None
+        return ET.fromstring(row[0]).find("Game")
     try:
-        gamereq = urllib2.Request(GAMEINFO_URL, urllib.urlencode({'id': result[3], 'platform' : platform}),
-                                  headers={'User-Agent' : "RetroPie Scraper Browser"})
-        remotedata = urllib2.urlopen( gamereq )
-        data = ET.parse(remotedata).getroot()
+        data = fetchXML(GAMEINFO_URL, {'id': gameID, 'platform' : platform}, fresh=fresh)
     except ET.ParseError:
-        print "Malformed XML found, skipping game.. (source: {%s})" % URL
+        print "Malformed XML found, skipping game.. (source: {%s})" % GAMEINFO_URL
         return None
     return data.find("Game")
 
@@ -260,29 +1355,25 @@ def getGamePlatform(nodes):
     else:
         return getText(nodes.find("Platform"))
 
+def lookupTitle(kind, title, *names):
+    entry = None
+    for name in names:
+        entry = loadTitles().get(kind, {}).get(name)
+        if entry is not None and entry[0]:
+            break
+    if entry is None or not entry[0]:
+        if args.v:
+            print "No title found for %s" % title
+        return title
+    if args.v:
+        print "Found real title %s for %s" % (entry[0], title)
+    return entry[0]
+
 def getScummvmTitle(title):
-    print "Fetching real title for %s from scummvm.org" % title
-    URL  = "http://scummvm.org/compatibility/DEV/%s" % title.split("-")[0]
-    data = "".join(urllib2.urlopen(URL).readlines())
-    m    = re.search('<td>(.*)</td>', data)
-    if m:
-       print "Found real title %s for %s on scummvm.org" % (m.group(1), title)
-       return m.groups()[0]
-    else:
-       print "No title found for %s on scummvm.org" % title
-       return title
+    return lookupTitle('scummvm', title, title, title.split("-")[0])
 
 def getRealArcadeTitle(title):
-    print "Fetching real title for %s from mamedb.com" % title
-    URL  = "http://www.mamedb.com/game/%s" % title
-    data = "".join(urllib2.urlopen(URL).readlines())
-    m    = re.search('<b>Name:.*</b>(.+) .*<br/><b>Year', data)
-    if m:
-       print "Found real title %s for %s on mamedb.com" % (m.group(1), title)
-       return m.group(1)
-    else:
-       print "No title found for %s on mamedb.com" % title
-       return title
+    return lookupTitle('arcade', title, title)
 
 def getDescription(nodes):
     if args.crc:
@@ -334,29 +1425,395 @@ def getGenres(nodes):
 
     return genres if len(genres)>0 else None
 
-def resizeImage(img, output):
-    maxWidth = args.w
-    maxHeight = args.t
-    if img.size[0] > maxWidth or img.size[1] > maxHeight:
+def resizeImage(path, maxWidth, maxHeight):
+    # Runs in a worker process, returns an error message if it failed
+    # and the time it took
+    start = time.time()
+    tmp = None
+    try:
+        img = Image.open(path)
+        # Opening only parsed the header, nothing to decode if it fits
+        if img.size[0] <= maxWidth and img.size[1] <= maxHeight:
+            return None, time.time() - start
         if img.size[0] > maxWidth:
             print "Boxart over %spx (width). Resizing boxart.." % maxWidth
         elif img.size[1] > maxHeight:
             print "Boxart over %spx (height). Resizing boxart.." % maxHeight
+        if img.format == 'JPEG':
+            # Let the JPEG decoder downscale while decoding
+            img.draft('RGB', (maxWidth, maxHeight))
+        format = img.format
         img.thumbnail((maxWidth, maxHeight), Image.ANTIALIAS)
-        img.save(output)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        # Keep the permissions of the image being replaced
+        os.fchmod(fd, os.stat(path).st_mode & 0o7777)
+        os.close(fd)
+        img.save(tmp, format)
+        os.rename(tmp, path)
+    except Exception as e:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        return str(e), time.time() - start
+    return None, time.time() - start
+
+def ignoreInterrupt():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def startImagePool():
+    # Started before any thread exists, as the workers are forked
+    global image_pool
+    if args.w and not args.noimg:
+        image_pool = multiprocessing.Pool(initializer=ignoreInterrupt)
+
+def stopImagePool():
+    if image_pool is not None:
+        image_pool.close()
+        image_pool.join()
+
+def imageIndexFile():
+    return os.environ['HOME']+"/.emulationstation/"+IMAGE_INDEX
+
+def imageIndex():
+    global image_index
+    if image_index is None:
+        try:
+            with open(imageIndexFile()) as f:
+                image_index = json.load(f)
+        except (IOError, ValueError):
+            image_index = {}
+    return image_index
+
+def saveImageIndex():
+    if not image_index:
+        return
+    indexfile = imageIndexFile()
+    with image_lock, lockedFile(indexfile):
+        # Other systems may be processing images at the same time
+        try:
+            with open(indexfile) as f:
+                merged = json.load(f)
+        except (IOError, ValueError):
+            merged = {}
+        merged.update(image_index)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(indexfile))
+        shareFile(fd)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(merged, f)
+        os.rename(tmp, indexfile)
+
+def linkFile(source, output):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(output))
+    os.close(fd)
+    os.remove(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        # Different filesystem, or no hardlinks there
+        return False
+    os.rename(tmp, output)
+    return True
+
+def queueImage(path):
+    # Boxart identical to one processed before (for any system) is
+    # hardlinked to it instead of being resized again
+    with open(path, 'rb') as f:
+        key = "%s-%sx%s" % (hashlib.sha1(f.read()).hexdigest(), args.w, args.t)
+    with image_lock:
+        known = imageIndex().get(key)
+    if known is not None and known[0] != os.path.abspath(path):
+        try:
+            st = os.stat(known[0])
+            if [st.st_size, st.st_mtime] == known[1:] and linkFile(known[0], path):
+                if args.v:
+                    print "Boxart identical to %s, linked.." % known[0]
+                recordCache('image', True)
+                return
+        except OSError:
+            pass
+    recordCache('image', False)
+
+    def done(result):
+        error, seconds = result
+        if args.w:
+            recordStage('resize', seconds)
+        if error:
+            print "Image resize error"
+            print error
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        with image_lock:
+            image_index[key] = [os.path.abspath(path), st.st_size, st.st_mtime]
+
+    if not args.w:
+        done((None, 0))
+    elif image_pool is None:
+        done(resizeImage(path, args.w, args.t))
+    else:
+        with image_lock:
+            image_jobs.append(image_pool.apply_async(resizeImage, (path, args.w, args.t), callback=done))
+
+def waitForImages():
+    while image_jobs:
+        with image_lock:
+            job = image_jobs.pop(0)
+        job.wait()
+    saveImageIndex()
+
+def getConnection(scheme, host):
+    conns = http_local.__dict__.setdefault('conns', {})
+    if (scheme, host) not in conns:
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=min(CONNECT_TIMEOUT, args.timeout))
+        else:
+            conn = httplib.HTTPConnection(host, timeout=min(CONNECT_TIMEOUT, args.timeout))
+        # Connecting should be quick, the server may take longer to answer
+        conn.connect()
+        conn.sock.settimeout(args.timeout)
+        conns[(scheme, host)] = conn
+    return conns[(scheme, host)]
+
+def dropConnection(scheme, host):
+    conn = http_local.__dict__.get('conns', {}).pop((scheme, host), None)
+    if conn is not None:
+        conn.close()
+
+def openURL(url, headers, data=None):
+    parts = urlparse.urlsplit(url)
+    target = urllib.quote(parts.path, safe="/%") + ('?'+parts.query if parts.query else '')
+    if data is not None:
+        headers = dict(headers, **{'Content-Type': "application/x-www-form-urlencoded"})
+    # A kept-alive connection may have been closed by the server meanwhile,
+    # so retry once on a fresh one
+    for attempt in range(2):
+        try:
+            conn = getConnection(parts.scheme, parts.netloc)
+            conn.request('GET' if data is None else 'POST', target, data, headers)
+            return conn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            dropConnection(parts.scheme, parts.netloc)
+            if attempt or isinstance(e, socket.timeout):
+                raise
+
+def hostLimits(host):
+    with host_lock:
+        if host not in host_limits:
+            host_limits[host] = (TokenBucket(args.rate) if args.rate > 0 else None,
+                                 AdaptiveLimit(max(args.j, 1)))
+        return host_limits[host]
+
+def backoff(attempt, retry_after):
+    # Exponential, with jitter so parallel requests don't retry in lockstep
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+    delay = random.uniform(delay/2, delay)
+    if retry_after is not None and retry_after.isdigit():
+        delay = max(delay, min(BACKOFF_MAX, int(retry_after)))
+    return delay
+
+def request(url, data=None, headers={}, handler=None):
+    # Every remote call goes through here: rate and concurrency limits of
+    # the server, redirects, and retries of transient failures. handler
+    # gets the response and returns the result, by default its body.
+    headers = dict({'User-Agent' : "RetroPie Scraper Browser"}, **headers)
+    attempt = redirects = 0
+    while True:
+        parts = urlparse.urlsplit(url)
+        bucket, limit = hostLimits(parts.netloc)
+        if bucket is not None:
+            bucket.take()
+        started = limit.acquire()
+        latency = None
+        congested = False
+        retry_after = None
+        try:
+            resp = openURL(url, headers, data)
+            latency = time.time() - started
+            if resp.status in REDIRECT_STATUS and resp.getheader('location') and redirects < MAX_REDIRECTS:
+                resp.read()
+                url = urlparse.urljoin(url, resp.getheader('location'))
+                if resp.status in (301, 302, 303):
+                    data = None
+                redirects += 1
+                continue
+            if resp.status in RETRY_STATUS:
+                resp.read()
+                raise TransientError("HTTP %s %s" % (resp.status, resp.reason), resp.getheader('retry-after'))
+            if handler is not None:
+                return handler(resp)
+            body = ResponseReader(resp).read()
+            if resp.status != 200:
+                raise IOError("HTTP %s %s (%s)" % (resp.status, resp.reason, url))
+            return body
+        except (TransientError, httplib.HTTPException, socket.error) as e:
+            dropConnection(parts.scheme, parts.netloc)
+            congested = isinstance(e, (TransientError, socket.timeout))
+            if attempt >= args.retries:
+                raise
+            retry_after = getattr(e, 'retry_after', None)
+            error = str(e) or e.__class__.__name__
+        except:
+            # The response may not have been read to the end
+            dropConnection(parts.scheme, parts.netloc)
+            raise
+        finally:
+            limit.release(started, latency, congested)
+
+        delay = backoff(attempt, retry_after)
+        attempt += 1
+        print "Request to %s failed (%s), retrying in %.1fs.." % (parts.netloc, error, delay)
+        recordStage('backoff', delay)
+        time.sleep(delay)
+
+def fetchURL(url, data=None):
+    return request(url, data, {'Accept-Encoding': "gzip"})
+
+def boxartIndex(folder):
+    with boxart_lock:
+        if folder not in boxart_indexes:
+            try:
+                with open(os.path.join(folder, BOXART_INDEX)) as f:
+                    boxart_indexes[folder] = json.load(f)
+            except (IOError, ValueError):
+                boxart_indexes[folder] = {}
+        return boxart_indexes[folder]
+
+def saveBoxartIndexes():
+    with boxart_lock:
+        for folder, index in boxart_indexes.items():
+            fd, tmp = tempfile.mkstemp(dir=folder)
+            shareFile(fd)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmp, os.path.join(folder, BOXART_INDEX))
+        boxart_indexes.clear()
 
 def downloadBoxart(path, output):
-    if args.crc:
-        os.system("wget -q %s --output-document=\"%s\"" % (path,output))
+    url = path if args.crc else BANNERS_URL + path
+    folder, base = os.path.split(output)
+    key = os.path.splitext(base)[0]
+    index = boxartIndex(folder)
+
+    # Only ask for the image if it changed since we last downloaded it
+    headers = {}
+    known = index.get(key)
+    if known and known['url'] == url and os.path.exists(known['path']):
+        if known['etag']:
+            headers['If-None-Match'] = known['etag']
     else:
-        os.system("wget -q http://thegamesdb.net/banners/%s --output-document=\"%s\"" % (path,output))
-
-def skipGame(list, filepath):
-    for game in list.iter("game"):
-        if game.findtext("path") == filepath:
-            if args.v:
-                print "Game \"%s\" already in gamelist. Skipping.." % os.path.basename(filepath)
-            return True
+        known = None
+
+    def receive(resp):
+        # Returns where the boxart is, its index entry if it was
+        # downloaded (None if unchanged) and the bytes transferred
+        etag = resp.getheader('etag')
+        length = resp.getheader('content-length')
+        if known and (resp.status == 304 or (resp.status == 200 and etag == known['etag']
+                                             and length == known['length'])):
+            if resp.status == 304:
+                resp.read()
+            else:
+                # Server ignored If-None-Match, don't bother reading the body
+                dropConnection(*urlparse.urlsplit(url)[:2])
+            return known['path'], None, 0
+        if resp.status != 200:
+            resp.read()
+            raise IOError("HTTP %s %s (%s)" % (resp.status, resp.reason, url))
+
+        # Stream into a temporary file, the real extension is only known
+        # once the first bytes arrived
+        fd, tmp = tempfile.mkstemp(dir=folder)
+        shareFile(fd)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                chunk = resp.read(DOWNLOAD_CHUNK)
+                kind = imghdr.what(None, chunk)
+                while chunk:
+                    f.write(chunk)
+                    size += len(chunk)
+                    chunk = resp.read(DOWNLOAD_CHUNK)
+            imgpath = os.path.splitext(output)[0] + ('.'+kind if kind else os.path.splitext(output)[1])
+            os.rename(tmp, imgpath)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return imgpath, {'url': url, 'etag': etag, 'length': length, 'path': imgpath}, size
+
+    start = time.time()
+    imgpath, entry, size = request(url, headers=headers, handler=receive)
+    recordStage('boxart', time.time() - start, size)
+    recordCache('boxart', entry is None)
+    if entry is None:
+        if args.v:
+            print "Boxart unchanged, skipping download.."
+        return imgpath
+
+    with boxart_lock:
+        index[key] = entry
+    return imgpath
+
+def indexGamelist(file):
+    games = {}
+    for entry in streamGamelist(file):
+        if entry.tag == "game":
+            games[entry.findtext("path")] = entry.findtext("id")
+    return games
+
+def loadManifest():
+    # Size, modification time and matched id of every scraped file
+    try:
+        with open(MANIFEST) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def saveManifest(manifest):
+    fd, tmp = tempfile.mkstemp(dir=".")
+    shareFile(fd)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmp, MANIFEST)
+
+def loadFolderIndex(extensions):
+    # Listings only hold matching files, so they are useless if the
+    # system's extensions changed
+    try:
+        with open(FOLDER_INDEX) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if index.get('extensions') != list(extensions):
+        return {}
+    return index.get('folders', {})
+
+def saveFolderIndex(extensions, folders):
+    fd, tmp = tempfile.mkstemp(dir=".")
+    shareFile(fd)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'extensions': list(extensions), 'folders': folders}, f)
+    os.rename(tmp, FOLDER_INDEX)
+
+def loadQueue():
+    # Ambiguous matches waiting for --review, with their ranked options
+    try:
+        with open(REVIEW_QUEUE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def saveQueue(queue):
+    if not queue:
+        if os.path.exists(REVIEW_QUEUE):
+            os.remove(REVIEW_QUEUE)
+        return
+    fd, tmp = tempfile.mkstemp(dir=".")
+    shareFile(fd)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(queue, f)
+    os.rename(tmp, REVIEW_QUEUE)
 
 def chooseResult(options):
     if len(options) > 0:
@@ -389,66 +1846,177 @@ def chooseResult(options):
         raise ValueError
 
 
-def autoChooseBestResult(nodes,t):
-    results = nodes.findall('Game')
-    t = t.split('(', 1)[0]
-    if len(results) > 1:
-
-        sep = ' |' # remove platform name
-        lista = []
-        listb = []
-        listc = []
-        for i,v in enumerate(results): # Do it backwards to eliminate false positives
-            a = (str(getTitle(v).split(sep, 1)[0]).split('(', 1)[0])
-            lista.append(a)
-            listb.append(i)
-        listc = list(lista)
-        listc.sort(key=len)
-        x = 0
-        for n in reversed(listc):
-            s = difflib.SequenceMatcher(None, t, lista[lista.index(n)]).ratio()
-            if s > x:
-                x = s
-                xx = lista.index(n)
-        ss = int(x * 100)
-        print "Game Title Found  " + str(ss) + "% Chance : " + lista[xx]
-        return xx
+def makeGame(result, filepath, root, filename, fields=REFRESH_FIELDS):
+    str_id = getId(result)
+    str_title = getTitle(result)
+    str_des = getDescription(result)
+    str_img = getImage(result)
+    str_rd = getRelDate(result)
+    str_pub = getPublisher(result)
+    str_dev = getDeveloper(result)
+    str_rating = getRating(result)
+    lst_genres = getGenres(result)
+
+    if str_title is None:
+        return None
+
+    game = Element('game')
+    id = SubElement(game, 'id')
+    path = SubElement(game, 'path')
+    name = SubElement(game, 'name')
+    desc = SubElement(game, 'desc')
+    image = SubElement(game, 'image')
+    releasedate = SubElement(game, 'releasedate')
+    publisher = SubElement(game, 'publisher')
+    developer = SubElement(game, 'developer')
+    rating = SubElement(game, 'rating')
+    genres = SubElement(game, 'genres')
+
+    id.text = str_id
+    path.text = filepath
+    name.text = str_title
+    print "Game Found: %s" % str_title
+
+    if str_des is not None:
+        desc.text = str_des
+
+    if str_img is not None and args.noimg is False and 'image' in fields:
+        # Store boxart in a boxart/ folder (create if needed)
+        boxart_folder = os.path.abspath(os.path.join(root, 'boxart'))
+        if args.newpath is True:
+            boxart_folder = './boxart'
+
+        try:
+            os.mkdir(boxart_folder)
+        except OSError:
+            # Already there (or just created by another worker)
+            if not os.path.isdir(boxart_folder):
+                raise
+
+        imgpath = os.path.join(boxart_folder, filename+os.path.splitext(str_img)[1])
+
+        print "Downloading boxart.."
+
+        try:
+            imgpath = downloadBoxart(str_img,imgpath)
+            image.text = imgpath
+        except Exception as e:
+            print "Boxart download failed: %s" % e
+            imgpath = None
+
+        if imgpath is not None:
+            queueImage(imgpath)
+
+    if str_rd is not None:
+        releasedate.text = str_rd
+
+    if str_pub is not None:
+        publisher.text = str_pub
+
+    if str_dev is not None:
+        developer.text = str_dev
+
+    if str_rating is not None:
+        flt_rating = float(str_rating)
+        rating.text = "%.6f" % flt_rating
     else:
-        return 0
+        rating.text = "0.000000"
 
-def scanFiles(SystemInfo):
-    name = SystemInfo[0]
-    if name == "scummvm":
-        global SCUMMVM
-        SCUMMVM = True
-    folderRoms = SystemInfo[1]
-    extension = SystemInfo[2]
-    platformID = SystemInfo[3]
+    if lst_genres is not None:
+        for genre in lst_genres:
+            newgenre = SubElement(genres, 'genre')
+            newgenre.text = genre.strip()
 
-    global gamelistExists
-    global existinglist
-    gamelistExists = False
+    return game
 
-    gamelist = Element('gameList')
-    folderRoms = os.path.expanduser(folderRoms)
+def fetchGame(gameID, platform, filepath, root, filename):
+    try:
+        data = getGameData(gameID, platform)
+        if data is None:
+            return None
+        return makeGame(data, filepath, root, filename)
+    except Exception as e:
+        print "Exception caught! %s" % e
+        return None
+
+def fieldValue(elem):
+    # Text of a field and of its children (genres), regardless of layout
+    if elem is None:
+        return None
+    return (elem.text or '').strip(), [fieldValue(child) for child in elem]
+
+def refreshGame(entry, platform, fields):
+    # Returns the gamelist entry with fields updated from thegamesdb, or
+    # None if none of them changed
+    path = entry.findtext("path")
+    try:
+        data = getGameData(entry.findtext("id"), platform, fresh=True)
+        if data is None:
+            return None
+        game = makeGame(data, path, os.path.dirname(path), os.path.splitext(os.path.basename(path))[0], fields)
+    except Exception as e:
+        print "Exception caught! %s" % e
+        return None
+    if game is None:
+        return None
+
+    changed = False
+    for field in fields:
+        new = game.find(field)
+        old = entry.find(field)
+        # Keep the current boxart if there is none to replace it
+        if field == 'image' and not new.text:
+            continue
+        if fieldValue(new) == fieldValue(old):
+            continue
+        changed = True
+        if old is None:
+            entry.append(new)
+        else:
+            entry[list(entry).index(old)] = new
+    return entry if changed else None
+
+def addGame(writer, manifest, stat, game):
+    if game is not None:
+        writer.add(game)
+        if stat is not None:
+            manifest[game.findtext("path")] = stat + [game.findtext("id")]
 
+def getDestination(name, folderRoms):
     if args.newpath is False:
-        destinationFolder = folderRoms;
+        return folderRoms
     else:
-        destinationFolder = os.environ['HOME']+"/.emulationstation/%s/" % name
+        return os.environ['HOME']+"/.emulationstation/%s/" % name
+
+def openDestination(name, folderRoms):
+    # gamelist.xml (and boxart with -newpath) is written in the current folder
+    destinationFolder = getDestination(name, folderRoms)
     try:
         os.chdir(destinationFolder)
     except OSError as e:
         print "%s : %s" % (destinationFolder, e.strerror)
-        return
+        return False
+    return True
 
-    platform_gamelist = getPlatformGameList(platformID)
+def loadGamelist():
+    global gamelistExists
+    global existinggames
+    gamelistExists = False
 
-    print "Scanning folder..(%s)" % folderRoms
+    # Games left in the journal by an interrupted run are kept
+    if os.path.exists(JOURNAL):
+        recovered = readJournal()
+        if recovered:
+            print "Recovering %s games from an interrupted run.." % len(recovered)
+            try:
+                commitGamelist(set(e.findtext("path") for e in recovered), False)
+            except ET.ParseError:
+                commitGamelist(set(), True)
+        os.remove(JOURNAL)
 
     if os.path.exists("gamelist.xml"):
         try:
-            existinglist = ET.parse("gamelist.xml")
+            existinggames = indexGamelist("gamelist.xml")
             gamelistExists=True
             if args.v:
                 print "Gamelist already exists: %s" % os.path.abspath("gamelist.xml")
@@ -456,115 +2024,642 @@ def scanFiles(SystemInfo):
             gamelistExists = False
             print "There was an error parsing the list or file is empty"
 
-    for root, dirs, allfiles in os.walk(folderRoms, followlinks=True):
-        allfiles.sort()
+def closeGamelist(writer):
+    writer.close()
+    if not writer.added:
+        print "No new games added."
+    else:
+        print "{} games added.".format(writer.added)
+        if gamelistExists and args.f is False:
+            print "Done! %s updated." % (os.getcwd()+"/gamelist.xml")
+        else:
+            print "Done! List saved on %s" % (os.getcwd()+"/gamelist.xml")
+
+def scanFiles(SystemInfo):
+    name = SystemInfo[0]
+    folderRoms = SystemInfo[1]
+    extension = SystemInfo[2]
+    platformID = SystemInfo[3]
+    setSystemKind(name, platformID)
+
+    folderRoms = os.path.expanduser(folderRoms)
+
+    if not openDestination(name, folderRoms):
+        return
+
+    print "Scanning folder..(%s)" % folderRoms
+    resetStats()
+    started = time.time()
+    loadGamelist()
+
+    # Only files that are new, or changed since they were scraped, need work
+    manifest = loadManifest()
+    newmanifest = {}
+    todo = []
+    found = set()
+    extensions = tuple(e for e in extension.split(' ') if e)
+    folders = {} if args.rescan else loadFolderIndex(extensions)
+    newfolders = {}
+    scanned = time.time()
+    for root, allfiles, unchanged in walkRoms(folderRoms, extensions, folders, newfolders):
         for files in allfiles:
-            if files.endswith(tuple(extension.split(' '))):
+            filepath = os.path.abspath(os.path.join(root, files))
+            found.add(filepath)
+            old = manifest.get(filepath)
+            if unchanged and old is not None:
+                # Nothing was added, removed or renamed in this folder
+                stat = old[:2]
+            else:
                 try:
-                    filepath = os.path.abspath(os.path.join(root, files))
-                    filename = os.path.splitext(files)[0]
+                    st = os.stat(filepath)
+                    stat = [st.st_size, st.st_mtime]
+                except OSError:
+                    stat = None
+
+            if gamelistExists and not args.f and filepath in existinggames:
+                # Entries scraped before the manifest existed are kept as is
+                if old is None or old[:2] == stat:
+                    newmanifest[filepath] = stat + [existinggames[filepath]] if stat else old
+                    if args.v:
+                        print "Game \"%s\" already in gamelist. Skipping.." % files
+                    continue
+                print "\"%s\" changed since it was scraped." % files
+            todo.append((root, files, filepath, stat))
+    saveFolderIndex(extensions, newfolders)
+    recordStage('scan', time.time() - scanned)
+
+    if gamelistExists and not args.f:
+        removed = sorted(set(existinggames) - found)
+        if removed:
+            print "%s games in the gamelist are no longer on disk." % len(removed)
+            if args.v:
+                for filepath in removed:
+                    print "  %s" % filepath
 
-                    if gamelistExists and not args.f:
-                        if skipGame(existinglist,filepath):
-                            continue
+    # With -crc, picked matches are remembered by CRC (see matchKey), so
+    # the files left to scrape are hashed; nothing is hashed otherwise
+    crcs = {}
+    if todo and args.crc:
+        try:
+            crcs = crcFiles([filepath for root, files, filepath, stat in todo], extension.split(' '))
+        except KeyboardInterrupt:
+            print "Ctrl+C detected. Closing work now..."
+            return
+
+    catalog = None
+    if todo:
+        try:
+            platform = getPlatformName(platformID)
+            # Not needed if every file was matched before
+            if not all(knownMatch(matchKey(filepath, platformID, crcs.get(filepath)))
+                       for root, files, filepath, stat in todo):
+                with timedStage('catalog'):
+                    catalog = loadCatalog(platform)
+        except (CacheMiss, IOError) as e:
+            print "Skipping %s, game list not available: %s" % (name, e)
+            return
+
+    # In lucky and queue mode nothing is interactive, so game data and boxart
+    # can be fetched in the background while the next files are being matched
+    pool = None
+    if (args.l or args.queue) and args.j > 1:
+        pool = ThreadPool(args.j)
+    pending = collections.deque()
+    writer = GamelistWriter(replace=args.f or not gamelistExists)
+    queue = loadQueue()
+    queued = 0
+
+    for done, (root, files, filepath, stat) in enumerate(todo):
+        reportProgress(name, done, len(todo), writer.added)
+        try:
+            filename = os.path.splitext(files)[0]
+
+            print "\nTrying to identify %s.." % files
+            if args.v and filepath in crcs:
+                print "CRC: %s" % crcs[filepath]
+
+            queue.pop(filepath, None)
+            try:
+                match = matchGame(filepath, platformID, catalog, crcs.get(filepath))
+            except ReviewNeeded as e:
+                queue[filepath] = {'root': root, 'stat': stat, 'options': e.options,
+                                   'key': matchKey(filepath, platformID, crcs.get(filepath))}
+                queued += 1
+                print "No clear match, queued for review (%s options)." % len(e.options)
+                continue
+            if match is None:
+                continue
+
+            if pool is None:
+                addGame(writer, newmanifest, stat, fetchGame(match[3], platform, filepath, root, filename))
+                continue
+
+            pending.append((stat, pool.apply_async(fetchGame, (match[3], platform, filepath, root, filename))))
+            # Merge finished games in file order, and keep at most
+            # two batches in flight so memory stays bounded
+            while len(pending) > args.j*2 or (pending and pending[0][1].ready()):
+                stat, result = pending.popleft()
+                addGame(writer, newmanifest, stat, result.get())
+        except KeyboardInterrupt:
+            print "Ctrl+C detected. Closing work now..."
+            break
+        except Exception as e:
+            print "Exception caught! %s" % e
+
+    if pool is not None:
+        try:
+            while pending:
+                stat, result = pending.popleft()
+                addGame(writer, newmanifest, stat, result.get())
+        except KeyboardInterrupt:
+            print "Ctrl+C detected. Closing work now..."
+            pool.terminate()
+        pool.close()
+        pool.join()
+    saveBoxartIndexes()
+    waitForImages()
+    saveQueue(queue)
+    saveMatches()
+    closeGamelist(writer)
+    # Changed files that weren't scraped again (no match, skipped, queued,
+    # interrupted) keep their old record, so they still look changed
+    for filepath in found:
+        if filepath not in newmanifest and filepath in manifest:
+            newmanifest[filepath] = manifest[filepath]
+    saveManifest(newmanifest)
+    reportProgress(name, len(todo), len(todo), writer.added)
+    if queued:
+        print "%s games queued for review, run with --review to pick their match." % queued
+    if args.stats:
+        emitStats(statsSummary(name, files=len(found), todo=len(todo), added=writer.added,
+                               queued=queued, seconds=round(time.time() - started, 4)))
+    return catalog
+
+def reportProgress(name, done, total, added):
+    if progress_queue is not None:
+        progress_queue.put((name, done, total, added))
+
+def initWorker(queue, workers):
+    global progress_queue
+    progress_queue = queue
+    # Each worker limits its own requests, together they keep to --rate
+    args.rate /= workers
+    # Ctrl+C is handled by the parent, which terminates the workers
+    ignoreInterrupt()
+
+def logsFolder():
+    return os.environ['HOME']+"/.emulationstation/"+LOGS
+
+def logFile(name):
+    return os.path.join(logsFolder(), '%s.log' % name.replace('/', '_'))
+
+def scanGroup(systems):
+    # Runs in its own process, so the working folder, globals and
+    # connections are not shared with other systems
+    for system in systems:
+        sys.stdout = open(logFile(system[0]), 'w')
+        try:
+            scanFiles(system)
+        except Exception as e:
+            print "Exception caught! %s" % e
+        finally:
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
+
+def scanParallel(systems):
+    # Systems writing to the same folder are scanned by the same worker
+    groups = collections.OrderedDict()
+    for system in systems:
+        folder = os.path.abspath(getDestination(system[0], os.path.expanduser(system[1])))
+        groups.setdefault(folder, []).append(system)
+
+    logs = logsFolder()
+    if not os.path.exists(logs):
+        os.makedirs(logs)
+    print "Scanning %s systems, %s at a time (logs in %s).." % (len(systems), args.systems_parallel, logs)
+
+    queue = multiprocessing.Queue()
+    workers = min(args.systems_parallel, len(groups))
+    pool = multiprocessing.Pool(workers, initWorker, (queue, workers),
+                                maxtasksperchild=1)
+    tasks = [pool.apply_async(scanGroup, (group,)) for group in groups.values()]
+    pool.close()
+
+    status = collections.OrderedDict()
+    last = time.time()
+    try:
+        while not all(task.ready() for task in tasks):
+            try:
+                name, done, total, added = queue.get(timeout=1)
+                status[name] = (done, total, added)
+            except Queue.Empty:
+                pass
+            if status and time.time() - last >= PROGRESS_INTERVAL:
+                print "Progress: " + ", ".join("%s %s/%s (%s added)" % ((name,) + v) for name, v in status.items())
+                last = time.time()
+    except KeyboardInterrupt:
+        print "Ctrl+C detected. Closing work now..."
+        pool.terminate()
+    pool.join()
+
+    while True:
+        try:
+            name, done, total, added = queue.get(timeout=0.1)
+            status[name] = (done, total, added)
+        except Queue.Empty:
+            break
+    for system in systems:
+        if system[0] in status:
+            print "%s: %s games added." % (system[0], status[system[0]][2])
+        else:
+            print "%s: nothing scanned, see %s" % (system[0], logFile(system[0]))
+
+def refreshGames(SystemInfo):
+    name = SystemInfo[0]
+    folderRoms = os.path.expanduser(SystemInfo[1])
+    platformID = SystemInfo[3]
+    fields = args.refresh.split(',')
+
+    if not openDestination(name, folderRoms):
+        return
+    loadGamelist()
+    if not gamelistExists:
+        print "No gamelist to refresh for %s." % name
+        return
+    print "Refreshing %s..(%s)" % (', '.join(fields), os.path.abspath("gamelist.xml"))
+    resetStats()
+    started = time.time()
+    platform = getPlatformName(platformID)
 
-                    print "\nTrying to identify %s.." % files
+    # Only changed games go through the journal, they keep their place
+    # in gamelist.xml when it is committed
+    pool = None
+    if args.j > 1:
+        pool = ThreadPool(args.j)
+    pending = collections.deque()
+    writer = GamelistWriter()
+    total = 0
+    try:
+        for entry in streamGamelist("gamelist.xml"):
+            if entry.tag != "game" or not entry.findtext("id") or not entry.findtext("path"):
+                continue
+            total += 1
+            print "\nRefreshing %s.." % os.path.basename(entry.findtext("path"))
+            if pool is None:
+                addGame(writer, {}, None, refreshGame(entry, platform, fields))
+                continue
+            pending.append(pool.apply_async(refreshGame, (entry, platform, fields)))
+            while len(pending) > args.j*2 or (pending and pending[0].ready()):
+                addGame(writer, {}, None, pending.popleft().get())
+        while pending:
+            addGame(writer, {}, None, pending.popleft().get())
+    except KeyboardInterrupt:
+        print "Ctrl+C detected. Closing work now..."
+        if pool is not None:
+            pool.terminate()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    saveBoxartIndexes()
+    waitForImages()
+    writer.close()
+    print "%s of %s games updated." % (writer.added, total)
+    if args.stats:
+        emitStats(statsSummary(name, files=total, added=writer.added, seconds=round(time.time() - started, 4)))
+
+class Inotify(object):
+    """Just enough of Linux inotify (through libc) to hear about files
+    written, moved or linked into the watched folders."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ISDIR       = 0x40000000
+    IN_CLOEXEC     = 0x00080000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, self.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self, timeout):
+        # (watch, mask, name) of the events received within timeout
+        try:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return []
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        data = os.read(self.fd, 64*1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, size = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            events.append((wd, mask, data[offset:offset+size].rstrip('\0')))
+            offset += size
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class WatchedSystem(object):
+    """A system kept loaded by --watch: its gamelist index, manifest and
+    game list stay in memory between new ROMs."""
+
+    def __init__(self, SystemInfo):
+        self.info = SystemInfo
+        self.name = SystemInfo[0]
+        self.folder = os.path.abspath(os.path.expanduser(SystemInfo[1]))
+        self.extensions = tuple(e for e in SystemInfo[2].split(' ') if e)
+        self.platformID = SystemInfo[3]
+        self.games = None
+        self.manifest = None
+        self.mtime = None
+        self.catalog = None
+        self.loaded = 0
+        self.pending = {}   # new files, and when they were last touched
+
+    def gamelistTime(self):
+        try:
+            return os.stat("gamelist.xml").st_mtime
+        except OSError:
+            return None
 
-                    data = getGameInfo(filepath, platformID, platform_gamelist)
+    def load(self):
+        # Called in the destination folder. Loaded again only if someone
+        # else (EmulationStation on exit) rewrote gamelist.xml.
+        if self.games is not None and self.mtime == self.gamelistTime():
+            return
+        loadGamelist()
+        self.games = dict(existinggames) if gamelistExists else {}
+        self.manifest = loadManifest()
+        self.mtime = self.gamelistTime()
+
+    def preload(self, catalog):
+        # The game list loaded by the first scan is kept, or loaded now,
+        # so the first new ROM doesn't wait for it
+        if catalog is not None:
+            self.catalog = catalog
+            self.loaded = time.time()
+            return
+        try:
+            self.loadCatalog()
+        except (CacheMiss, IOError) as e:
+            print "Game list of %s not available yet: %s" % (self.name, e)
+
+    def loadCatalog(self):
+        if self.catalog is None or time.time() - self.loaded > CACHE_TTL[GAMESLIST_URL]:
+            with timedStage('catalog'):
+                self.catalog = loadCatalog(getPlatformName(self.platformID))
+            self.loaded = time.time()
+        return self.catalog
+
+def isLink(path):
+    try:
+        return os.path.islink(path) or (os.path.isfile(path) and os.stat(path).st_nlink > 1)
+    except OSError:
+        return False
+
+def watchTree(inotify, folders, system, folder):
+    # Watches folder and everything below it, returns the ROMs found there.
+    # Systems sharing a folder share its watch.
+    found = []
+    for root, files, unchanged in walkRoms(folder, system.extensions, {}, {}):
+        try:
+            systems = folders.setdefault(inotify.watch(root), [])
+            if not any(watched is system for watched, path in systems):
+                systems.append((system, root))
+        except OSError as e:
+            print "Can't watch %s: %s" % (root, e.strerror)
+        found.extend(os.path.join(root, f) for f in files)
+    return found
+
+def scrapeNew(system, paths):
+    # Scrapes the new or changed files among paths and appends them to the
+    # gamelist. Returns False if the game list couldn't be loaded.
+    if not openDestination(system.name, system.folder):
+        return True
+    setSystemKind(system.name, system.platformID)
+    system.load()
+
+    todo = []
+    for filepath in sorted(paths):
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            continue
+        stat = [st.st_size, st.st_mtime]
+        old = system.manifest.get(filepath)
+        if filepath in system.games and (old is None or old[:2] == stat):
+            continue
+        todo.append((os.path.dirname(filepath), os.path.basename(filepath), filepath, stat))
+    if not todo:
+        return True
 
-                    if data is None:
+    print "\n%s: %s new files.." % (system.name, len(todo))
+    crcs = {}
+    if args.crc:
+        crcs = crcFiles([filepath for root, files, filepath, stat in todo], system.extensions)
+    try:
+        platform = getPlatformName(system.platformID)
+        catalog = None
+        if not all(knownMatch(matchKey(filepath, system.platformID, crcs.get(filepath)))
+                   for root, files, filepath, stat in todo):
+            catalog = system.loadCatalog()
+    except (CacheMiss, IOError) as e:
+        print "Game list of %s not available, retrying later: %s" % (system.name, e)
+        return False
+
+    writer = GamelistWriter()
+    queue = loadQueue()
+    for root, files, filepath, stat in todo:
+        try:
+            print "\nTrying to identify %s.." % files
+            queue.pop(filepath, None)
+            try:
+                match = matchGame(filepath, system.platformID, catalog, crcs.get(filepath))
+            except ReviewNeeded as e:
+                queue[filepath] = {'root': root, 'stat': stat, 'options': e.options,
+                                   'key': matchKey(filepath, system.platformID, crcs.get(filepath))}
+                print "No clear match, queued for review (%s options)." % len(e.options)
+                continue
+            if match is None:
+                continue
+            game = fetchGame(match[3], platform, filepath, root, os.path.splitext(files)[0])
+            addGame(writer, system.manifest, stat, game)
+            if game is not None:
+                system.games[filepath] = game.findtext("id")
+        except Exception as e:
+            print "Exception caught! %s" % e
+    saveBoxartIndexes()
+    waitForImages()
+    saveQueue(queue)
+    saveMatches()
+    writer.close()
+    saveManifest(system.manifest)
+    system.mtime = system.gamelistTime()
+    print "%s: %s games added to %s" % (system.name, writer.added, os.path.abspath("gamelist.xml"))
+    return True
+
+def watchSystems(systems):
+    try:
+        inotify = Inotify()
+    except OSError as e:
+        print "Can't watch for new ROMs: %s" % e.strerror
+        return
+
+    # Watching starts before the first scan, so nothing copied meanwhile
+    # is missed
+    watched = [WatchedSystem(SystemInfo) for SystemInfo in systems]
+    folders = {}
+    for system in watched:
+        watchTree(inotify, folders, system, system.folder)
+    for system in watched:
+        catalog = scanFiles(system.info)
+        if openDestination(system.name, system.folder):
+            system.load()
+            system.preload(catalog)
+    print "\nWatching %s folders for new ROMs, press Ctrl+C to stop.." % len(folders)
+
+    try:
+        while True:
+            now = time.time()
+            for system in watched:
+                # Files are scraped once they've been left alone for a while
+                ready = [path for path, last in system.pending.items() if now - last >= WATCH_SETTLE]
+                if not ready:
+                    continue
+                if scrapeNew(system, ready):
+                    for path in ready:
+                        if system.pending.get(path) <= now - WATCH_SETTLE:
+                            del system.pending[path]
+                else:
+                    for path in ready:
+                        system.pending[path] = now + WATCH_RETRY
+
+            waits = [last + WATCH_SETTLE - time.time() for system in watched for last in system.pending.values()]
+            timeout = max(0, min(waits)) if waits else None
+            for wd, mask, name in inotify.read(timeout):
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    # Events were lost, look at every folder again
+                    print "Too many changes at once, scanning again.."
+                    for system in watched:
+                        for path in watchTree(inotify, folders, system, system.folder):
+                            system.pending.setdefault(path, time.time())
+                    continue
+                if mask & Inotify.IN_IGNORED:
+                    folders.pop(wd, None)
+                    continue
+                for system, folder in list(folders.get(wd, ())):
+                    path = os.path.join(folder, name)
+                    if mask & Inotify.IN_ISDIR:
+                        if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                            for found in watchTree(inotify, folders, system, path):
+                                system.pending[found] = time.time()
                         continue
-                    else:
-                        result = data
-
-                    str_id = getId(result)
-                    str_title = getTitle(result)
-                    str_des = getDescription(result)
-                    str_img = getImage(result)
-                    str_rd = getRelDate(result)
-                    str_pub = getPublisher(result)
-                    str_dev = getDeveloper(result)
-                    str_rating = getRating(result)
-                    lst_genres = getGenres(result)
-
-                    if str_title is not None:
-                        game = SubElement(gamelist, 'game')
-                        id = SubElement(game, 'id')
-                        path = SubElement(game, 'path')
-                        name = SubElement(game, 'name')
-                        desc = SubElement(game, 'desc')
-                        image = SubElement(game, 'image')
-                        releasedate = SubElement(game, 'releasedate')
-                        publisher = SubElement(game, 'publisher')
-                        developer = SubElement(game, 'developer')
-                        rating = SubElement(game, 'rating')
-                        genres = SubElement(game, 'genres')
-
-                        id.text = str_id
-                        path.text = filepath
-                        name.text = str_title
-                        print "Game Found: %s" % str_title
-
-                    if str_des is not None:
-                        desc.text = str_des
-
-                    if str_img is not None and args.noimg is False:
-                        # Store boxart in a boxart/ folder (create if needed)
-                        boxart_folder = os.path.abspath(os.path.join(root, 'boxart'))
-                        if args.newpath is True:
-                            boxart_folder = './boxart'
-
-                        if not os.path.exists(boxart_folder):
-                            os.mkdir(boxart_folder)
-
-                        imgpath = os.path.join(boxart_folder, filename+os.path.splitext(str_img)[1])
-
-                        print "Downloading boxart.."
-
-                        downloadBoxart(str_img,imgpath)
-                        imgpath = fixExtension(imgpath)
-                        image.text = imgpath
-
-                        if args.w or args.t:
-                            try:
-                                resizeImage(Image.open(imgpath), imgpath)
-                            except Exception as e:
-                                print "Image resize error"
-                                print str(e)
-
-                    if str_rd is not None:
-                        releasedate.text = str_rd
-
-                    if str_pub is not None:
-                        publisher.text = str_pub
-
-                    if str_dev is not None:
-                        developer.text = str_dev
-
-                    if str_rating is not None:
-                        flt_rating = float(str_rating)
-                        rating.text = "%.6f" % flt_rating
-                    else:
-                        rating.text = "0.000000"
-
-                    if lst_genres is not None:
-                        for genre in lst_genres:
-                            newgenre = SubElement(genres, 'genre')
-                            newgenre.text = genre.strip()
-                except KeyboardInterrupt:
-                    print "Ctrl+C detected. Closing work now..."
+                    if not name.endswith(system.extensions):
+                        continue
+                    # Files being copied are picked up when closed, links
+                    # (symbolic, or hard ones, which already have a name
+                    # elsewhere) as soon as they appear
+                    if mask & Inotify.IN_CREATE and not isLink(path):
+                        continue
+                    system.pending[path] = time.time()
+    except KeyboardInterrupt:
+        print "Ctrl+C detected. Closing work now..."
+    inotify.close()
+
+def reviewQueue(SystemInfo):
+    name = SystemInfo[0]
+    folderRoms = os.path.expanduser(SystemInfo[1])
+    platformID = SystemInfo[3]
+    setSystemKind(name, platformID)
+
+    if not openDestination(name, folderRoms):
+        return
+    queue = loadQueue()
+    if not queue:
+        print "Nothing to review for %s." % name
+        return
+
+    print "Reviewing %s games..(%s)" % (len(queue), folderRoms)
+    loadGamelist()
+    platform = getPlatformName(platformID)
+    writer = GamelistWriter(replace=not gamelistExists)
+    manifest = loadManifest()
+    catalog = None
+
+    # Choices come from the ranked options stored while scanning, the
+    # catalog is only needed when searching for another title
+    for filepath in sorted(queue):
+        entry = queue[filepath]
+        if not os.path.exists(filepath):
+            del queue[filepath]
+            continue
+        print "\nReviewing %s.." % os.path.basename(filepath)
+        options = entry['options']
+        result = None
+        try:
+            while True:
+                try:
+                    choice = chooseResult(options)
+                    if choice is not None:
+                        result = options[choice]
                     break
+                except ManualTitleInterrupt:
+                    if catalog is None:
+                        try:
+                            catalog = loadCatalog(platform)
+                        except (CacheMiss, IOError) as e:
+                            # Still pick from the stored options
+                            print "Can't search, game list not available: %s" % e
+                            continue
+                    options = searchTitle(filepath, romTitle(filepath), catalog)
+                except KeyboardInterrupt:
+                    raise KeyboardInterrupt
                 except Exception as e:
-                    print "Exception caught! %s" % e
+                    print "Invalid selection (%s) " % e
+        except KeyboardInterrupt:
+            print "Ctrl+C detected. Closing work now..."
+            break
 
-    if gamelist.find("game") is None:
-        print "No new games added."
-    else:
-        print "{} games added.".format(len(gamelist))
-        exportList(gamelist)
+        del queue[filepath]
+        if result is None:
+            print "Skipping game..."
+            continue
+        rememberMatch(entry.get('key') or matchKey(filepath, platformID), result, True)
+        filename = os.path.splitext(os.path.basename(filepath))[0]
+        addGame(writer, manifest, entry['stat'],
+                fetchGame(result[3], platform, filepath, entry['root'], filename))
+
+    saveBoxartIndexes()
+    waitForImages()
+    saveQueue(queue)
+    saveMatches()
+    closeGamelist(writer)
+    saveManifest(manifest)
+    if queue:
+        print "%s games left to review." % len(queue)
 
 try:
-    if os.getuid() == 0:
+    if os.getuid() == 0 and os.getenv("SUDO_USER"):
         os.environ['HOME']="/home/"+os.getenv("SUDO_USER")
     config=open(os.environ['HOME']+"/.emulationstation/es_systems.cfg")
 except IOError as e:
@@ -573,6 +2668,39 @@ except IOError as e:
 ES_systems = readConfig(config)
 print parser.description
 
+if args.update_platforms:
+    updatePlatforms()
+    sys.exit()
+if args.import_titles:
+    importTitles(args.import_titles)
+    sys.exit()
+loadPlatforms()
+
+if args.no_cache and args.cache_only:
+    sys.exit("--no-cache and --cache-only can't be used together")
+if args.cache_dir is None:
+    args.cache_dir = os.environ['HOME']+"/.emulationstation/cache/"
+args.cache_dir = os.path.expanduser(args.cache_dir)
+# Both are written after changing into the systems' folders
+if args.stats and args.stats != '-':
+    args.stats = os.path.abspath(os.path.expanduser(args.stats))
+if args.profile:
+    args.profile = os.path.abspath(os.path.expanduser(args.profile))
+
+if args.export_matches:
+    exportMatches(args.export_matches)
+    sys.exit()
+if args.import_matches:
+    importMatches(args.import_matches)
+    sys.exit()
+if args.export_db:
+    exportSnapshot(args.export_db)
+    sys.exit()
+if args.db:
+    if not os.path.exists(args.db):
+        sys.exit("Catalog snapshot not found: %s" % args.db)
+    loadSnapshotPlatforms()
+
 if args.pisize:
     print "Using Raspberry Pi boxart size: (%spx x %spx)" % (DEFAULT_WIDTH, DEFAULT_HEIGHT)
     args.w = DEFAULT_WIDTH
@@ -584,6 +2712,16 @@ else:
     if args.t:
         print "Max height set: %spx." % str(args.t)
         args.w = args.w if args.w else 999999
+if args.w and Image is None:
+    print "PIL is not installed, boxart won't be resized."
+    args.w = args.t = None
+if args.refresh:
+    unknown = set(args.refresh.split(',')) - set(REFRESH_FIELDS)
+    if unknown:
+        sys.exit("Unknown fields for --refresh: %s (known: %s)" % (', '.join(sorted(unknown)), ','.join(REFRESH_FIELDS)))
+    if args.noimg and 'image' in args.refresh.split(','):
+        sys.exit("--refresh image can't be used with -noimg")
+    print "Refreshing %s of the games in gamelist.xml." % args.refresh
 if args.noimg:
     print "Boxart downloading disabled."
 if args.f:
@@ -592,17 +2730,66 @@ if args.v:
     print "Verbose mode enabled."
 if args.crc:
     print "CRC scraping enabled."
+if args.queue and not args.l:
+    print "Queueing unclear matches for review."
+if args.j > 1:
+    if args.l or args.queue:
+        print "Fetching up to %s games in parallel." % args.j
+    else:
+        print "Parallel fetching (-j) is only available with -l or --queue, ignoring."
+if args.systems_parallel > 1 and not (args.l or args.queue):
+    print "Parallel systems (--systems-parallel) is only available with -l or --queue, ignoring."
+if args.watch:
+    if args.review or args.refresh:
+        sys.exit("--watch can't be used with --review or --refresh")
+    if not (args.l or args.queue):
+        sys.exit("--watch needs -l or --queue, there is nobody to ask about unclear matches")
+if args.no_cache:
+    print "Response cache disabled."
+elif args.cache_only:
+    print "Offline mode: using cached responses only (%s)." % args.cache_dir
+if args.db:
+    print "Using catalog snapshot %s." % args.db
+profiler = None
+if args.profile:
+    print "Profiling enabled, stats saved on %s." % args.profile
+    profiler = cProfile.Profile()
+    profiler.enable()
 if args.p:
     print "Partial scraping enabled. Systems found:"
     for i,v in enumerate(ES_systems):
         print "[%s] %s" % (i,v[0])
+    startImagePool()
     try:
         var = int(raw_input("System ID: "))
-        scanFiles(ES_systems[var])
+        if args.review:
+            reviewQueue(ES_systems[var])
+        elif args.refresh:
+            refreshGames(ES_systems[var])
+        elif args.watch:
+            watchSystems([ES_systems[var]])
+        else:
+            scanFiles(ES_systems[var])
     except:
         sys.exit()
+elif args.systems_parallel > 1 and (args.l or args.queue) and not (args.review or args.refresh or args.watch):
+    scanParallel(ES_systems)
+elif args.watch:
+    startImagePool()
+    watchSystems(ES_systems)
 else:
+    startImagePool()
     for i,v in enumerate(ES_systems):
-        scanFiles(ES_systems[i])
+        if args.review:
+            reviewQueue(ES_systems[i])
+        elif args.refresh:
+            refreshGames(ES_systems[i])
+        else:
+            scanFiles(ES_systems[i])
+stopImagePool()
+if profiler is not None:
+    profiler.disable()
+    profiler.dump_stats(args.profile)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
 
 print "All done!"